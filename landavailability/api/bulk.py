@@ -0,0 +1,66 @@
+'''Bulk writes keyed on the natural (unique) key of a model.
+'''
+from collections import OrderedDict
+
+from django.db import connections, router
+from django.db.models import sql
+
+
+def upsert(model, objs, key_field, update_fields=None, using=None):
+    '''Inserts the given model instances, or updates the existing rows with
+    the same (unique) `key_field`, with a single
+    INSERT ... ON CONFLICT DO UPDATE statement, and sets their primary keys.
+
+    When several instances share a key the last one wins, as it would when
+    saving them one after the other.
+    Returns the list of instances that were created (rather than updated).
+    '''
+    objs = list(objs)
+    if not objs:
+        return []
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    key = opts.get_field(key_field)
+
+    # ON CONFLICT can't update the same row twice in one statement
+    by_key = OrderedDict()
+    for obj in objs:
+        by_key.setdefault(
+            key.to_python(getattr(obj, key.attname)), []).append(obj)
+    unique_objs = [same_key[-1] for same_key in by_key.values()]
+
+    fields = [f for f in opts.concrete_fields if not f.primary_key]
+    if update_fields is None:
+        update_fields = [f.name for f in fields if f.name != key.name]
+    # DO NOTHING wouldn't return the existing rows
+    assignments = ', '.join(
+        '{0} = EXCLUDED.{0}'.format(qn(opts.get_field(name).column))
+        for name in (update_fields or [key.name]))
+
+    query = sql.InsertQuery(model)
+    query.insert_values(fields, unique_objs)
+    compiler = query.get_compiler(using=using)
+
+    created = []
+    with connection.cursor() as cursor:
+        for insert_sql, params in compiler.as_sql():
+            cursor.execute(
+                '{0} ON CONFLICT ({1}) DO UPDATE SET {2} '
+                'RETURNING {3}, {1}, (xmax = 0)'.format(
+                    insert_sql, qn(key.column), assignments,
+                    qn(opts.pk.column)),
+                params)
+
+            for pk, key_value, inserted in cursor.fetchall():
+                same_key = by_key[key.to_python(key_value)]
+                for obj in same_key:
+                    obj.pk = pk
+                    obj._state.adding = False
+                    obj._state.db = using
+                if inserted:
+                    created.append(same_key[-1])
+
+    return created
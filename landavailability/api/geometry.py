@@ -0,0 +1,116 @@
+'''Lighter representations of the Location geometries, for the responses.
+
+The geometry of a Location is returned at one of these levels:
+    full        the stored MultiPolygon
+    simplified  simplified by PostGIS, with a tolerance of about a pixel at
+                the given map zoom level
+    centroid    the centroid of the geometry
+    none        no geometry (null)
+and its coordinates can be rounded to a number of decimal places.
+'''
+from django.contrib.gis.db.models import GeometryField
+from django.db.models import Func
+from django.db.models.expressions import RawSQL
+
+GEOMETRY_LEVELS = ('full', 'simplified', 'centroid', 'none')
+
+DEFAULT_ZOOM = 12
+MAX_ZOOM = 22
+MAX_PRECISION = 15
+
+
+class SimplifiedGeometry(Func):
+    '''ST_SimplifyPreserveTopology of a geography column, as a geometry.'''
+    function = 'ST_SimplifyPreserveTopology'
+    template = '%(function)s(%(expressions)s::geometry, %(tolerance)s)'
+
+    def __init__(self, expression, tolerance, **extra):
+        super().__init__(
+            expression, tolerance=float(tolerance),
+            output_field=GeometryField(srid=4326), **extra)
+
+
+class CentroidGeometry(Func):
+    '''ST_Centroid of a geography column, as a geometry.'''
+    function = 'ST_Centroid'
+    template = '%(function)s(%(expressions)s::geometry)'
+
+    def __init__(self, expression, **extra):
+        super().__init__(
+            expression, output_field=GeometryField(srid=4326), **extra)
+
+
+def simplify_tolerance(zoom):
+    '''Returns the size of a pixel, in degrees, of a 256px tile map at the
+    given zoom level.
+    '''
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def geometry_options(query_params):
+    '''Returns the geometry, zoom and precision options of a request.
+    Raises ValueError, with a message for the user, if they are invalid.
+    '''
+    geometry = query_params.get('geometry', 'full')
+    if geometry not in GEOMETRY_LEVELS:
+        raise ValueError('geometry parameter must be one of: {}'.format(
+            ', '.join(GEOMETRY_LEVELS)))
+
+    options = {'geometry': geometry}
+    for param, default, maximum in (('zoom', DEFAULT_ZOOM, MAX_ZOOM),
+                                    ('precision', None, MAX_PRECISION)):
+        value = query_params.get(param, default)
+        if value is not None:
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(
+                    '{} parameter must be an integer'.format(param))
+            if not 0 <= value <= maximum:
+                raise ValueError(
+                    '{} parameter must be between 0 and {}'.format(
+                        param, maximum))
+        options[param] = value
+
+    return options
+
+
+def with_geometry(locations, geometry='full', zoom=DEFAULT_ZOOM, **kwargs):
+    '''Returns the Locations queryset, fetching the geometry at the given
+    level (as `display_geom`) instead of the stored one.
+    '''
+    if geometry == 'simplified':
+        return locations.defer('geom').annotate(
+            display_geom=SimplifiedGeometry(
+                'geom', simplify_tolerance(zoom)))
+    elif geometry == 'centroid':
+        return locations.defer('geom').annotate(
+            display_geom=CentroidGeometry('geom'))
+    elif geometry == 'none':
+        return locations.defer('geom').annotate(
+            display_geom=RawSQL(
+                'NULL', (), output_field=GeometryField(srid=4326)))
+    return locations
+
+
+def display_geometry_sql(column, geometry='full', zoom=DEFAULT_ZOOM,
+                         **kwargs):
+    '''Returns the SQL, and its params, of the geometry at the given level of
+    a geography column (as with_geometry would fetch it), or None for no
+    geometry.
+    '''
+    if geometry == 'simplified':
+        return ('ST_SimplifyPreserveTopology({0}::geometry, %s)'.format(
+            column), [simplify_tolerance(zoom)])
+    elif geometry == 'centroid':
+        return 'ST_Centroid({0}::geometry)'.format(column), []
+    elif geometry == 'none':
+        return None, []
+    return column, []
+
+
+def round_coordinates(coordinates, precision):
+    '''Rounds the (nested) GeoJSON coordinates to `precision` decimals.'''
+    if isinstance(coordinates, (list, tuple)):
+        return [round_coordinates(c, precision) for c in coordinates]
+    return round(coordinates, precision)
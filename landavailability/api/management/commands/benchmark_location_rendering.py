@@ -0,0 +1,48 @@
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from api.geometry import GEOMETRY_LEVELS, with_geometry
+from api.models import Location
+from api.renderers import LocationsJSONRenderer
+from api.serializers import LocationSerializer, location_rows
+
+
+class Command(BaseCommand):
+    help = ('Time the rendering of a page of Locations with '
+            'LocationSerializer and JSONRenderer, against location_rows and '
+            'LocationsJSONRenderer (as used by the locations search)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument(
+            '--geometry', default='full', choices=GEOMETRY_LEVELS)
+
+    def handle(self, *args, **options):
+        context = {'geometry': options['geometry']}
+        locations = with_geometry(
+            Location.objects.order_by('id'), **context)[:options['page_size']]
+        if not locations.exists():
+            raise CommandError('There are no Locations to render')
+
+        def serializer_response():
+            return JSONRenderer().render(LocationSerializer(
+                locations.all(), many=True, context=context).data)
+
+        def rows_response():
+            return LocationsJSONRenderer().render(
+                list(location_rows(
+                    locations.all(), context=context).values()))
+
+        if serializer_response() != rows_response():
+            raise CommandError('The responses are different')
+
+        timings = []
+        for name, render in (('LocationSerializer', serializer_response),
+                             ('location_rows', rows_response)):
+            seconds = min(timeit.repeat(
+                render, number=1, repeat=options['repeat']))
+            timings.append(seconds)
+            print('{0}: {1:.1f} ms'.format(name, seconds * 1000))
+        print('Speed-up: {0:.1f}x'.format(timings[0] / timings[1]))
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from django.contrib.gis.geos import Point
 from api.models import Address
 from .importers import CSVImportCommand
@@ -5,16 +6,31 @@ from .importers import CSVImportCommand
 
 class Command(CSVImportCommand):
     help = 'Import addresses from a CSV file'
+    model = Address
+    key_field = 'uprn'
 
-    def process_row(self, row):
-        print(row)
-
-        try:
-            address = Address.objects.get(uprn=row[0])
-        except Address.DoesNotExist:
-            address = Address()
-            address.uprn = row[0]
+    staging_columns = (
+        'uprn', 'udprn', 'address_line_1', 'address_line_2',
+        'address_line_3', 'city', 'county', 'postcode', 'country_code',
+        'latitude', 'longitude')
+    staging_fields = OrderedDict([
+        ('uprn', 'uprn'),
+        ('address_line_1', 'address_line_1'),
+        ('address_line_2', 'address_line_2'),
+        ('address_line_3', 'address_line_3'),
+        ('city', 'city'),
+        ('county', 'county'),
+        ('postcode', "upper(replace(btrim(postcode), ' ', ''))"),
+        ('country_code', 'country_code'),
+        ('point',
+            'ST_SetSRID(ST_MakePoint(longitude::float8, latitude::float8), '
+            '4326)::geography'),
+    ])
+    staging_where = "latitude <> '' AND longitude <> ''"
 
+    def parse_row(self, row):
+        address = Address()
+        address.uprn = row[0]
         address.address_line_1 = row[2]
         address.address_line_2 = row[3]
         address.address_line_3 = row[4]
@@ -24,7 +40,4 @@ class Command(CSVImportCommand):
         address.country_code = row[8]
         address.point = Point(float(row[10]), float(row[9]), srid=4326)
 
-        try:
-            address.save()
-        except Exception as e:
-            print('Could not add: {0}'.format(row))
+        return address
@@ -1,22 +1,41 @@
+from collections import OrderedDict
 from django.contrib.gis.geos import Point
 from api.models import CodePoint
+from api.postcodes import forget_all_postcodes
 from .importers import CSVImportCommand
 
 
 class Command(CSVImportCommand):
     help = 'Import codepoints from a CSV file'
+    model = CodePoint
+    key_field = 'postcode'
 
-    def process_row(self, row):
-        print(row)
+    staging_columns = (
+        'postcode', 'quality', 'eastings', 'northings', 'country',
+        'nhs_region', 'nhs_health_authority', 'county', 'district', 'ward')
+    staging_fields = OrderedDict([
+        ('postcode', "upper(replace(btrim(postcode), ' ', ''))"),
+        ('quality', "NULLIF(quality, '')::integer"),
+        ('point',
+            'ST_Transform(ST_SetSRID(ST_MakePoint('
+            'eastings::float8, northings::float8), 27700), 4326)::geography'),
+        ('country', 'country'),
+        ('nhs_region', 'nhs_region'),
+        ('nhs_health_authority', 'nhs_health_authority'),
+        ('county', 'county'),
+        ('district', 'district'),
+        ('ward', 'ward'),
+    ])
+    staging_where = "eastings <> '' AND northings <> ''"
 
-        postcode = row[0].strip().replace(' ', '').upper()
-
-        try:
-            codepoint = CodePoint.objects.get(postcode=postcode)
-        except CodePoint.DoesNotExist:
-            codepoint = CodePoint()
-            codepoint.postcode = postcode
+    def handle(self, *args, **options):
+        super().handle(*args, **options)
+        # the bulk writes don't send post_save
+        forget_all_postcodes()
 
+    def parse_row(self, row):
+        codepoint = CodePoint()
+        codepoint.postcode = row[0].strip().replace(' ', '').upper()
         codepoint.quality = row[1]
         codepoint.point = Point(
             float(row[2]), float(row[3]), srid=27700)
@@ -27,7 +46,4 @@ class Command(CSVImportCommand):
         codepoint.district = row[8]
         codepoint.ward = row[9]
 
-        try:
-            codepoint.save()
-        except Exception as e:
-            print('Could not add: {0}'.format(row))
+        return codepoint
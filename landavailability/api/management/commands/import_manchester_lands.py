@@ -1,46 +1,62 @@
-from django.core.management.base import BaseCommand, CommandError
-from django.contrib.gis.geos import MultiPolygon, Point
 from django.contrib.gis.geos import GEOSGeometry
-from django.contrib.gis.db.models.functions import Centroid
+from django.db import transaction
 import json
 from api.models import Location
+from api.nearest import enrich_locations
+from .importers import GeoJSONImportCommand
 
 
-class Command(BaseCommand):
+class Command(GeoJSONImportCommand):
     help = 'Import land data for Manchester from a JSON file'
 
-    def add_arguments(self, parser):
-        parser.add_argument('json_file', type=str)
-
-    def handle(self, *args, **options):
-        json_file_name = options.get('json_file')
+    def parse_feature(self, feature, existing):
+        '''Returns the Location described by the feature, updating the one in
+        `existing` (by name) if any, or None if the feature is skipped.
+        '''
+        if feature['geometry']['type'] != 'MultiPolygon':
+            return None
+
+        name = feature['properties']['address']
+        location = existing.get(name)
+        if location is None:
+            location = Location()
+            location.name = name
+            location.geom = GEOSGeometry(
+                json.dumps(feature['geometry']), srid=3857)
+            existing[name] = location
 
-        if json_file_name:
-            with open(json_file_name) as jsonfile:
-                data = json.load(jsonfile)
+        location.point = location.geom.centroid
+        location.authority = feature['properties']['la']
+        location.owner = feature['properties']['la']
 
-            for feature in data['features']:
-                self.process_feature(feature)
+        return location
 
     def process_feature(self, feature):
-        if feature['geometry']['type'] == 'MultiPolygon':
-            multi_polygon = GEOSGeometry(
-                json.dumps(feature['geometry']), srid=3857)
-
-            try:
-                location = Location.objects.get(
-                    name=feature['properties']['address'])
-            except Location.DoesNotExist:
-                location = Location()
-                location.name = feature['properties']['address']
-                location.geom = multi_polygon
-
-            location.point = location.geom.centroid
-            location.authority = feature['properties']['la']
-            location.owner = feature['properties']['la']
-
-            try:
-                location.save()
-            except Exception as e:
-                print('Could not add: {0} because: {1}'.format(
-                    location.name, e))
+        self.process_features([feature])
+
+    def process_features(self, features):
+        names = [
+            feature['properties']['address'] for feature in features
+            if feature['geometry']['type'] == 'MultiPolygon']
+        existing = dict(
+            (location.name, location)
+            for location in Location.objects.filter(name__in=names))
+
+        locations = []
+        for feature in features:
+            location = self.parse_feature(feature, existing)
+            if location is not None and location not in locations:
+                locations.append(location)
+
+        # Resolve the nearest amenities of the new Locations with one query
+        enrich_locations(
+            [location for location in locations if location.pk is None])
+
+        with transaction.atomic():
+            for location in locations:
+                try:
+                    with transaction.atomic():
+                        location.save(enrich=False)
+                except Exception as e:
+                    print('Could not add: {0} because: {1}'.format(
+                        location.name, e))
@@ -1,32 +1,33 @@
 from django.contrib.gis.geos import Point
 from api.models import MetroTube
+from api.nearest import refresh_nearest_for
 from .importers import CSVImportCommand
 
 
 class Command(CSVImportCommand):
     help = 'Import Metro and Tube from a CSV file'
+    model = MetroTube
+    key_field = 'atco_code'
 
     def __init__(self):
         super().__init__(skip_header=True, encoding='ISO-8859-1')
 
-    def process_row(self, row):
-        print('{0} - {1}'.format(row[0], row[4]))
+    def format_row(self, row):
+        return '{0} - {1}'.format(row[0], row[4])
 
+    def parse_row(self, row):
         # Only import Metro and Tube
-        if row[31] == 'TMU':
-            try:
-                metrotube = MetroTube.objects.get(atco_code=row[0])
-            except MetroTube.DoesNotExist:
-                metrotube = MetroTube()
-                metrotube.atco_code = row[0]
-
-            metrotube.naptan_code = row[2]
-            metrotube.name = row[4]
-            metrotube.locality = row[18]
-            metrotube.point = Point(float(row[29]), float(row[30]), srid=4326)
-
-            try:
-                metrotube.save()
-                metrotube.update_close_locations()
-            except Exception as e:
-                print('Could not add: {0} because {1}'.format(row, e))
+        if row[31] != 'TMU':
+            return None
+
+        metrotube = MetroTube()
+        metrotube.atco_code = row[0]
+        metrotube.naptan_code = row[2]
+        metrotube.name = row[4]
+        metrotube.locality = row[18]
+        metrotube.point = Point(float(row[29]), float(row[30]), srid=4326)
+
+        return metrotube
+
+    def after_save(self, objs):
+        refresh_nearest_for(objs)
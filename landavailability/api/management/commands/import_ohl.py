@@ -1,22 +1,18 @@
 from django.contrib.gis.geos import GEOSGeometry
-from django.contrib.gis.geos import MultiLineString, LineString
-from .importers import ShapefileImportCommand
 from api.models import OverheadLine
+from api.nearest import refresh_nearest_for
+from .importers import ShapefileImportCommand
 import json
 
 
 class Command(ShapefileImportCommand):
     help = 'Import Overhead Lines from a *.shp file'
+    model = OverheadLine
+    key_field = 'gdo_gid'
 
-    def process_record(self, record):
-        print(record.record)
-
-        try:
-            ohl = OverheadLine.objects.get(gdo_gid=record.record[0])
-        except OverheadLine.DoesNotExist:
-            ohl = OverheadLine()
-            ohl.gdo_gid = record.record[0]
-
+    def parse_record(self, record):
+        ohl = OverheadLine()
+        ohl.gdo_gid = record.record[0]
         ohl.route_asset = record.record[1]
         ohl.towers = record.record[2]
         ohl.action_dtt = record.record[3]
@@ -27,8 +23,7 @@ class Command(ShapefileImportCommand):
         ohl.geom = GEOSGeometry(
                 json.dumps(record.shape.__geo_interface__), srid=27700)
 
-        try:
-            ohl.save()
-            ohl.update_close_locations()
-        except Exception as e:
-            print('Could not add: {0}'.format(record.record))
+        return ohl
+
+    def after_save(self, objs):
+        refresh_nearest_for(objs)
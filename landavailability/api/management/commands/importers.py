@@ -1,25 +1,341 @@
+from contextlib import contextmanager
 from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections, transaction
+from itertools import islice
 import csv
+import json
+import multiprocessing
 import shapefile
+from api.bulk import upsert
+from api.models import DatasetVersion
+from api.nearest import deferred_refresh, extend_deferred, pop_deferred
 
 
-class CSVImportCommand(BaseCommand):
+DEFAULT_BATCH_SIZE = 1000
+
+
+def chunks(iterable, size):
+    '''Yields lists of up to `size` items from `iterable`.'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _JSONStream(object):
+    '''Decodes the JSON values of a text file one at a time, keeping only
+    the part of the file that hasn't been decoded yet in memory.
+    '''
+
+    def __init__(self, jsonfile, read_size):
+        self.jsonfile = jsonfile
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        # Read at least as much as is pending, so that decoding a large
+        # value doesn't rescan the buffer once per read_size
+        size = max(self.read_size, len(self.buffer) - self.pos)
+        data = self.jsonfile.read(size)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        self.eof = not data
+        return not self.eof
+
+    def peek(self):
+        '''Returns the next non whitespace character, or '' at the end of
+        the file.
+        '''
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expecting {0!r} at {1!r}'.format(
+                char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value running up to the end of the buffer (e.g. a
+                # number) might continue in the rest of the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read()
+
+
+def iter_features(jsonfile, read_size=64 * 1024):
+    '''Yields the features of a GeoJSON FeatureCollection one at a time,
+    reading the file incrementally rather than loading it all, so that the
+    memory used depends on the size of a feature and not of the file.
+    The other members of the FeatureCollection are skipped.
+    '''
+    stream = _JSONStream(jsonfile, read_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+
+    while True:
+        key = stream.decode()
+        stream.expect(':')
+
+        if key == 'features':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield stream.decode()
+                    if stream.peek() == ']':
+                        stream.expect(']')
+                        break
+                    stream.expect(',')
+        else:
+            stream.decode()
+
+        if stream.peek() == '}':
+            return
+        stream.expect(',')
+
+
+class BatchImportCommand(BaseCommand):
+    # Commands set the model they import, along with its unique key, and
+    # write each batch of instances with one statement, in its own
+    # transaction.
+    model = None
+    key_field = None
+
+    def __init__(self):
+        super().__init__()
+        self.verbosity = 1
+
+    def after_save(self, objs):
+        '''Called with the instances saved by each batch (or row).'''
+        pass
+
+    def save_one(self, item, obj):
+        try:
+            with transaction.atomic():
+                obj.pk = self.model.objects.filter(
+                    **{self.key_field: getattr(obj, self.key_field)}).\
+                    values_list('pk', flat=True).first()
+                obj.save()
+                self.after_save([obj])
+        except Exception as e:
+            print('Could not add: {0} because {1}'.format(item, e))
+
+    def write_batch(self, objs):
+        '''Writes the instances with a single statement, which unlike save()
+        doesn't send any signal. Returns the instances that were created.
+        '''
+        return upsert(self.model, objs, self.key_field)
+
+    def save_batch(self, parsed):
+        '''Saves the (source item, unsaved instance) pairs in one
+        transaction.
+        '''
+        objs = [obj for item, obj in parsed]
+        try:
+            with transaction.atomic():
+                created = self.write_batch(objs)
+                DatasetVersion.bump()
+                self.after_save(objs)
+        except DatabaseError as e:
+            # Retry one item at a time, so that a bad one doesn't lose the
+            # whole batch
+            print('Could not add batch because {0}, '
+                  'retrying one at a time'.format(e))
+            for item, obj in parsed:
+                self.save_one(item, obj)
+            return
+
+        if self.verbosity > 0:
+            print('Imported {0} rows ({1} new)'.format(
+                len(objs), len(created)))
+
+
+class CSVImportCommand(BatchImportCommand):
     help = 'Import data from a CSV file'
 
+    # Commands that set model and key_field, and implement parse_row, are
+    # imported in batches.
+    # Commands that also name the CSV columns (staging_columns) and give the
+    # SQL expression of each model field over them (staging_fields) are
+    # loaded with COPY into a temporary staging table instead, and merged
+    # into the model's table with a single INSERT ... ON CONFLICT.
+    # staging_where optionally filters out the rows that can't be imported.
+    staging_columns = None
+    staging_fields = None
+    staging_where = None
+
     def __init__(self, skip_header=False, encoding=None):
+        super().__init__()
         self.skip_header = skip_header
         self.encoding = encoding
 
     def add_arguments(self, parser):
         parser.add_argument('csv_file', type=str)
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='Number of rows written in each transaction')
+        parser.add_argument(
+            '--row-by-row', action='store_true',
+            help='Save the rows one at a time')
+        parser.add_argument(
+            '--no-copy', action='store_true',
+            help='Import in batches rather than through a staging table')
+        parser.add_argument(
+            '--defer-nearest', action='store_true',
+            help='Refresh the nearest amenities of the Locations once, '
+                 'at the end of the import')
+
+    def format_row(self, row):
+        return row
+
+    def log_row(self, row):
+        if self.verbosity > 1:
+            print(self.format_row(row))
+
+    def parse_row(self, row):
+        '''Returns the unsaved model instance described by the row, or None
+        if the row should be skipped.
+        '''
+        return None
 
     def process_row(self, row):
-        pass
+        self.log_row(row)
+
+        try:
+            obj = self.parse_row(row)
+        except (ValueError, IndexError) as e:
+            print('Could not add: {0} because {1}'.format(row, e))
+            return
+
+        if obj is not None:
+            self.save_one(row, obj)
+
+    def process_rows(self, rows):
+        parsed = []
+        for row in rows:
+            self.log_row(row)
+
+            try:
+                obj = self.parse_row(row)
+            except (ValueError, IndexError) as e:
+                print('Could not add: {0} because {1}'.format(row, e))
+                continue
+
+            if obj is not None:
+                parsed.append((row, obj))
+
+        self.save_batch(parsed)
+
+    def copy_import(self, csv_file_name):
+        '''Streams the CSV file through COPY into a staging table, then
+        merges it into the model's table. The staging table is temporary, so
+        it is private to the import (concurrent ones each have their own)
+        and dropped with the transaction. When a key appears more than
+        once the last row wins, as it does when importing row by row.
+        Returns the number of (merged, new) rows.
+        '''
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        staging = qn(opts.db_table + '_staging')
+        key = qn(opts.get_field(self.key_field).column)
+
+        columns = [qn(column) for column in self.staging_columns]
+        copy_options = ['FORMAT csv', 'FORCE_NOT_NULL ({0})'.format(
+            ', '.join(columns))]
+        if self.skip_header:
+            copy_options.append('HEADER true')
+        if self.encoding:
+            copy_options.append("ENCODING '{0}'".format(self.encoding))
+
+        fields = [
+            qn(opts.get_field(name).column) for name in self.staging_fields]
+        expressions = [
+            '{0} AS {1}'.format(expression, field)
+            for expression, field in zip(
+                self.staging_fields.values(), fields)]
+        updates = [
+            '{0} = EXCLUDED.{0}'.format(field)
+            for field in fields if field != key]
+
+        merge_sql = (
+            'WITH merged AS ('
+            'INSERT INTO {table} ({fields}) '
+            'SELECT DISTINCT ON ({key}) {fields} FROM ('
+            'SELECT line, {expressions} FROM {staging}{where}'
+            ') AS staged '
+            'ORDER BY {key}, line DESC '
+            'ON CONFLICT ({key}) DO UPDATE SET {updates} '
+            'RETURNING (xmax = 0) AS inserted'
+            ') '
+            'SELECT count(*), count(*) FILTER (WHERE inserted) '
+            'FROM merged').format(
+                table=qn(opts.db_table),
+                fields=', '.join(fields),
+                key=key,
+                expressions=', '.join(expressions),
+                staging=staging,
+                where=(
+                    ' WHERE {0}'.format(self.staging_where)
+                    if self.staging_where else ''),
+                updates=', '.join(updates))
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE {0} (line bigserial, {1}) '
+                'ON COMMIT DROP'.format(
+                    staging,
+                    ', '.join('{0} text'.format(c) for c in columns)))
+
+            with open(csv_file_name, 'rb') as csvfile:
+                cursor.copy_expert(
+                    'COPY {0} ({1}) FROM STDIN WITH ({2})'.format(
+                        staging, ', '.join(columns), ', '.join(copy_options)),
+                    csvfile)
+
+            cursor.execute(merge_sql)
+            counts = cursor.fetchone()
+            DatasetVersion.bump()
+
+        return counts
 
     def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+
+        with deferred_refresh(enabled=options.get('defer_nearest')):
+            self.import_csv(**options)
+
+    def import_csv(self, **options):
         csv_file_name = options.get('csv_file')
+        batch_size = options.get('batch_size') or DEFAULT_BATCH_SIZE
 
-        if csv_file_name:
+        if csv_file_name and self.staging_columns and not (
+                options.get('row_by_row') or options.get('no_copy')):
+            merged, created = self.copy_import(csv_file_name)
+            if self.verbosity > 0:
+                print('Imported {0} rows ({1} new)'.format(merged, created))
+        elif csv_file_name:
             with open(
                     csv_file_name,
                     newline='', encoding=self.encoding) as csvfile:
@@ -29,25 +345,207 @@ class CSVImportCommand(BaseCommand):
                 if self.skip_header:
                     next(reader)
 
-                for row in reader:
-                    self.process_row(row)
+                if options.get('row_by_row'):
+                    for row in reader:
+                        self.process_row(row)
+                else:
+                    for rows in chunks(reader, batch_size):
+                        self.process_rows(rows)
+
+
+class GeoJSONImportCommand(BatchImportCommand):
+    help = 'Import data from a GeoJSON file'
+
+    # Commands that set model and key_field, and implement parse_feature,
+    # are imported in batches. The features are read from the file one at a
+    # time, so only a batch of them is held in memory.
+
+    def add_arguments(self, parser):
+        parser.add_argument('json_file', type=str)
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='Number of features written in each transaction')
+        parser.add_argument(
+            '--defer-nearest', action='store_true',
+            help='Refresh the nearest amenities of the Locations once, '
+                 'at the end of the import')
+
+    def format_feature(self, feature):
+        return feature.get('id')
+
+    def log_feature(self, feature):
+        if self.verbosity > 1:
+            print('Importing: {0}'.format(self.format_feature(feature)))
+
+    def parse_feature(self, feature):
+        '''Returns the unsaved model instance described by the feature, or
+        None if the feature should be skipped.
+        '''
+        return None
+
+    def process_feature(self, feature):
+        self.log_feature(feature)
+
+        try:
+            obj = self.parse_feature(feature)
+        except (ValueError, KeyError) as e:
+            print('Could not add: {0} because: {1}'.format(
+                self.format_feature(feature), e))
+            return
+
+        if obj is not None:
+            self.save_one(self.format_feature(feature), obj)
+
+    def process_features(self, features):
+        parsed = []
+        for feature in features:
+            self.log_feature(feature)
+
+            try:
+                obj = self.parse_feature(feature)
+            except (ValueError, KeyError) as e:
+                print('Could not add: {0} because: {1}'.format(
+                    self.format_feature(feature), e))
+                continue
+
+            if obj is not None:
+                parsed.append((self.format_feature(feature), obj))
+
+        self.save_batch(parsed)
+
+    def handle(self, *args, **options):
+        json_file_name = options.get('json_file')
+        self.verbosity = options.get('verbosity', 1)
+        batch_size = options.get('batch_size') or DEFAULT_BATCH_SIZE
 
+        if json_file_name:
+            with deferred_refresh(enabled=options.get('defer_nearest')), \
+                    open(json_file_name) as jsonfile:
+                for features in chunks(iter_features(jsonfile), batch_size):
+                    self.process_features(features)
 
-class ShapefileImportCommand(BaseCommand):
+
+@contextmanager
+def open_shapefile(shp_file_name):
+    '''Yields a shapefile.Reader of the file, and closes its files at the
+    end of the block (pyshp 1.2 readers don't close them themselves).
+    '''
+    reader = shapefile.Reader(shp_file_name)
+    try:
+        yield reader
+    finally:
+        for f in (reader.shp, reader.shx, reader.dbf):
+            if f is not None:
+                f.close()
+
+
+# The command run by the worker processes of a parallel shapefile import.
+# The pool is forked, so the command itself is inherited rather than pickled.
+_worker_command = None
+
+
+def _init_worker(command):
+    global _worker_command
+    _worker_command = command
+    # The amenities recorded before the fork belong to the parent
+    pop_deferred()
+
+
+def _import_shard(shard):
+    return _worker_command.import_shard(*shard)
+
+
+class ShapefileImportCommand(BatchImportCommand):
     help = 'Import data from a *.shp file'
 
+    # Commands that set model and key_field, and implement parse_record, are
+    # imported in batches of --chunk-size records. With --workers, the ranges
+    # of records are shared out to a pool of processes, each reading them
+    # from the shapefile and writing them through its own connection.
+
     def add_arguments(self, parser):
         parser.add_argument('shp_file', type=str)
+        parser.add_argument(
+            '--defer-nearest', action='store_true',
+            help='Refresh the nearest amenities of the Locations once, '
+                 'at the end of the import')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes importing the records')
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='Number of records written in each transaction')
 
-    def process_record(self, record):
-        pass
+    def log_record(self, record):
+        if self.verbosity > 1:
+            print(record.record)
+
+    def parse_record(self, record):
+        '''Returns the unsaved model instance described by the record, or
+        None if the record should be skipped.
+        '''
+        return None
+
+    def process_records(self, records):
+        parsed = []
+        for record in records:
+            if record.shape.shapeType == shapefile.NULL:
+                continue
+            self.log_record(record)
+
+            try:
+                obj = self.parse_record(record)
+            except (ValueError, IndexError) as e:
+                print('Could not add: {0} because {1}'.format(
+                    record.record, e))
+                continue
+
+            if obj is not None:
+                parsed.append((record.record, obj))
+
+        self.save_batch(parsed)
+
+    def import_shard(self, shp_file_name, start, stop):
+        '''Imports the records from `start` up to `stop`, in one batch.
+        Returns the amenities whose nearest Locations are still to be
+        refreshed, if the refresh is deferred.
+        '''
+        with open_shapefile(shp_file_name) as reader:
+            self.process_records(
+                reader.shapeRecord(i) for i in range(start, stop))
+        return pop_deferred()
+
+    def import_parallel(self, shp_file_name, workers, chunk_size):
+        with open_shapefile(shp_file_name) as reader:
+            num_records = reader.numRecords
+        shards = [
+            (shp_file_name, start, min(start + chunk_size, num_records))
+            for start in range(0, num_records, chunk_size)]
+
+        # Each worker opens its own connection, rather than sharing ours
+        connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        with context.Pool(
+                workers, initializer=_init_worker, initargs=(self,)) as pool:
+            for pending in pool.imap_unordered(_import_shard, shards):
+                if pending:
+                    extend_deferred(pending)
+            pool.close()
+            pool.join()
 
     def handle(self, *args, **options):
         shp_file_name = options.get('shp_file')
+        self.verbosity = options.get('verbosity', 1)
+        workers = options.get('workers') or 1
+        chunk_size = options.get('chunk_size') or DEFAULT_BATCH_SIZE
 
         if shp_file_name:
-            reader = shapefile.Reader(shp_file_name)
-            for record in reader.shapeRecords():
-                if record.shape.shapeType == shapefile.NULL:
-                    continue
-                self.process_record(record)
+            with deferred_refresh(enabled=options.get('defer_nearest')):
+                if workers > 1:
+                    self.import_parallel(shp_file_name, workers, chunk_size)
+                else:
+                    with open_shapefile(shp_file_name) as reader:
+                        for records in chunks(
+                                reader.iterShapeRecords(), chunk_size):
+                            self.process_records(records)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.nearest import refresh_greenbelt_overlap
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the subdivided Greenbelts, and refresh the greenbelt '
+            'overlap (and its ratio) of every Location')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = refresh_greenbelt_overlap()
+        print('Greenbelt overlap: updated {0} locations'.format(updated))
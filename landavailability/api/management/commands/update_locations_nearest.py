@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.nearest import (
+    AMENITIES, AMENITIES_BY_NAME, BATCH_SIZE, refresh_nearest)
+
+
+class Command(BaseCommand):
+    help = 'Refresh the nearest amenities of every Location'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'amenities', nargs='*', type=str,
+            help='Amenities to refresh (default: all of them). '
+                 'Choices: {0}'.format(
+                     ', '.join(amenity.name for amenity in AMENITIES)))
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        names = options.get('amenities') or [
+            amenity.name for amenity in AMENITIES]
+
+        for name in names:
+            if name not in AMENITIES_BY_NAME:
+                raise CommandError('Unknown amenity: {0}'.format(name))
+
+        for name in names:
+            updated = refresh_nearest(
+                name, batch_size=options.get('batch_size'))
+            print('Nearest {0}: updated {1} locations'.format(name, updated))
@@ -1,14 +1,10 @@
 from django.core.management.base import BaseCommand, CommandError
-from api.models import BusStop
+from api.nearest import refresh_nearest
 
 
 class Command(BaseCommand):
-    help = ''
+    help = 'Refresh the nearest bus stop of every Location'
 
     def handle(self, *args, **options):
-        bss = BusStop.objects.all()
-        total_busses = len(bss)
-
-        for i, bs in enumerate(bss):
-            print('Processing bus: {0} of {1}'.format(i, total_busses))
-            bs.update_close_locations()
+        updated = refresh_nearest('busstop')
+        print('Updated {0} locations'.format(updated))
@@ -1,8 +1,5 @@
 from api.models import Address, CodePoint
-
-
-def normalise_postcode(postcode):
-    return postcode.replace(' ', '').upper()
+from api.postcodes import normalise_postcode
 
 
 def get_address_from_postcode(postcode):
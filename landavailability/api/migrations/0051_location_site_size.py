@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0050_auto_20170706_0707'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='site_size',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+        # Same as Location.get_geom_area: the area in British National Grid
+        migrations.RunSQL(
+            'UPDATE api_location '
+            'SET site_size = abs(ST_Area(ST_Transform(geom::geometry, 27700)))',
+            migrations.RunSQL.noop,
+        ),
+    ]
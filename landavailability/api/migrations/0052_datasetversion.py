@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0051_location_site_size'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE SEQUENCE api_datasetversion_seq MINVALUE 0 START 0',
+            'DROP SEQUENCE api_datasetversion_seq'),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 17:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0052_datasetversion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_busstop',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.BusStop'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_trainstop',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.TrainStop'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_substation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.Substation'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_ohl',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.OverheadLine'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_motorway',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.Motorway'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_broadband',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.Broadband'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_primary_school',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='primary_school_locations', to='api.School'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_secondary_school',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='secondary_school_locations', to='api.School'),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='nearest_metrotube',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.MetroTube'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 18:55
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0053_location_nearest_on_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GreenbeltPart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geom', django.contrib.gis.db.models.fields.GeometryField(srid=27700)),
+                ('greenbelt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='api.Greenbelt')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='greenbelt_overlap_ratio',
+            field=models.FloatField(null=True),
+        ),
+        # Build the parts of the existing Greenbelts, and the overlap ratio
+        # of the existing Locations against them (as
+        # api.nearest.refresh_greenbelt_overlap does)
+        migrations.RunSQL(
+            'INSERT INTO api_greenbeltpart (greenbelt_id, geom) '
+            'SELECT g.id, ST_Subdivide(ST_Transform(g.geom::geometry, 27700), '
+            '256) FROM api_greenbelt AS g',
+            migrations.RunSQL.noop),
+        migrations.RunSQL(
+            'UPDATE api_location AS l '
+            'SET greenbelt_overlap_ratio = LEAST(1.0, COALESCE(('
+            'SELECT ST_Area(ST_Union(ST_CollectionExtract(ST_Intersection('
+            'p.geom, ST_Transform(l.geom::geometry, 27700)), 3))) '
+            'FROM api_greenbeltpart AS p '
+            'WHERE ST_Intersects(p.geom, ST_Transform(l.geom::geometry, 27700))'
+            ') / NULLIF(ST_Area(ST_Transform(l.geom::geometry, 27700)), 0), 0))',
+            migrations.RunSQL.noop),
+    ]
@@ -1,8 +1,8 @@
 from django.contrib.gis.db import models
-from django.contrib.gis.db.models.functions import Distance
-from django.contrib.gis.measure import D
-from django.db.models.signals import pre_delete, post_delete, post_save
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+import threading
 
 
 class Address(models.Model):
@@ -34,6 +34,16 @@ class CodePoint(models.Model):
     ward = models.CharField(null=True, blank=True, max_length=24)
 
 
+@receiver(post_save, sender=CodePoint, weak=False)
+@receiver(post_delete, sender=CodePoint, weak=False)
+def codepoint_forget_postcode_handler(sender, instance, **kwargs):
+    """
+    Whenever a CodePoint changes, we forget the cached point of its postcode.
+    """
+    from .postcodes import forget_postcode
+    forget_postcode(instance.postcode)
+
+
 class BusStop(models.Model):
     # Describes an instance of a bus stop
 
@@ -45,29 +55,20 @@ class BusStop(models.Model):
     road = models.CharField(max_length=255, blank=True, null=True)
     nptg_code = models.CharField(max_length=255, blank=True, null=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.point, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.point))
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'busstop', amenity_ids=[self.id], distance=default_range)
 
-        for location in locations:
-            if location.nearest_busstop:
-                if location.distance.m > location.nearest_busstop_distance:
-                    continue
 
-            location.nearest_busstop = self
-            location.nearest_busstop_distance = location.distance.m
-            location.save()
-
-
-@receiver(pre_delete, sender=BusStop, weak=False)
-def busstop_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=BusStop, weak=False)
+def busstop_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a BusStop, we search all the Locations using it
-    and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a BusStop, we point all the Locations which were
+    using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_busstop__id=instance.id).\
-        update(nearest_busstop=None, nearest_busstop_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('busstop', [instance.id])
 
 
 class TrainStop(models.Model):
@@ -83,29 +84,20 @@ class TrainStop(models.Model):
     nptg_code = models.CharField(max_length=255, blank=True, null=True)
     local_reference = models.CharField(max_length=255, blank=True, null=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.point, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.point))
-
-        for location in locations:
-            if location.nearest_trainstop:
-                if location.distance.m > location.nearest_trainstop_distance:
-                    continue
-
-            location.nearest_trainstop = self
-            location.nearest_trainstop_distance = location.distance.m
-            location.save()
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'trainstop', amenity_ids=[self.id], distance=default_range)
 
 
-@receiver(pre_delete, sender=TrainStop, weak=False)
-def trainstop_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=TrainStop, weak=False)
+def trainstop_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a TrainStop, we search all the Locations using it
-    and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a TrainStop, we point all the Locations which were
+    using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_trainstop__id=instance.id).\
-        update(nearest_trainstop=None, nearest_trainstop_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('trainstop', [instance.id])
 
 
 class Substation(models.Model):
@@ -120,29 +112,20 @@ class Substation(models.Model):
     gdo_gid = models.CharField(max_length=255, blank=True, null=True)
     geom = models.PolygonField(geography=True, spatial_index=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.geom, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.geom))
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'substation', amenity_ids=[self.id], distance=default_range)
 
-        for location in locations:
-            if location.nearest_substation:
-                if location.distance.m > location.nearest_substation_distance:
-                    continue
 
-            location.nearest_substation = self
-            location.nearest_substation_distance = location.distance.m
-            location.save()
-
-
-@receiver(pre_delete, sender=Substation, weak=False)
-def substation_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=Substation, weak=False)
+def substation_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a Substation, we search all the Locations using
-    it and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a Substation, we point all the Locations which were
+    using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_substation__id=instance.id).\
-        update(nearest_substation=None, nearest_substation_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('substation', [instance.id])
 
 
 class OverheadLine(models.Model):
@@ -158,29 +141,20 @@ class OverheadLine(models.Model):
     circuit_2 = models.CharField(max_length=255, blank=True, null=True)
     geom = models.GeometryField(geography=True, spatial_index=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.geom, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.geom))
-
-        for location in locations:
-            if location.nearest_ohl:
-                if location.distance.m > location.nearest_ohl_distance:
-                    continue
-
-            location.nearest_ohl = self
-            location.nearest_ohl_distance = location.distance.m
-            location.save()
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'ohl', amenity_ids=[self.id], distance=default_range)
 
 
-@receiver(pre_delete, sender=OverheadLine, weak=False)
-def overheadline_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=OverheadLine, weak=False)
+def overheadline_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete an Overhead Line, we search all the Locations
-    using it and we remove the reference, so the object can be safely deleted.
+    Whenever we delete an Overhead Line, we point all the Locations which
+    were using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_ohl__id=instance.id).\
-        update(nearest_ohl=None, nearest_ohl_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('ohl', [instance.id])
 
 
 class Motorway(models.Model):
@@ -190,29 +164,20 @@ class Motorway(models.Model):
     number = models.CharField(max_length=255, blank=True, null=True)
     point = models.PointField(geography=True, spatial_index=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.point, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.point))
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'motorway', amenity_ids=[self.id], distance=default_range)
 
-        for location in locations:
-            if location.nearest_motorway:
-                if location.distance.m > location.nearest_motorway_distance:
-                    continue
 
-            location.nearest_motorway = self
-            location.nearest_motorway_distance = location.distance.m
-            location.save()
-
-
-@receiver(pre_delete, sender=Motorway, weak=False)
-def motorway_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=Motorway, weak=False)
+def motorway_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a Motorway, we search all the Locations
-    using it and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a Motorway, we point all the Locations which were
+    using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_motorway__id=instance.id).\
-        update(nearest_motorway=None, nearest_motorway_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('motorway', [instance.id])
 
 
 class Broadband(models.Model):
@@ -235,36 +200,20 @@ class Broadband(models.Model):
     max_upload_speed = models.DecimalField(
         max_digits=5, decimal_places=2, null=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.point, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.point))
-
-        for location in locations:
-            if location.nearest_broadband:
-                if location.distance.m > location.nearest_broadband_distance:
-                    continue
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'broadband', amenity_ids=[self.id], distance=default_range)
 
-            location.nearest_broadband = self
-            location.nearest_broadband_distance = location.distance.m
 
-            if self.speed_30_mb_percentage > 0:
-                location.nearest_broadband_fast = True
-
-            location.save()
-
-
-@receiver(pre_delete, sender=Broadband, weak=False)
-def broadband_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=Broadband, weak=False)
+def broadband_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a Broadband, we search all the Locations
-    using it and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a Broadband, we point all the Locations which were
+    using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_broadband__id=instance.id).\
-        update(
-            nearest_broadband=None,
-            nearest_broadband_distance=0,
-            nearest_broadband_fast=False)
+    from .nearest import replace_nearest
+    replace_nearest('broadband', [instance.id])
 
 
 class Greenbelt(models.Model):
@@ -281,12 +230,8 @@ class Greenbelt(models.Model):
 
 @receiver(post_save, sender=Greenbelt, weak=False)
 def greenbelt_update_overlapping_locations(sender, instance, **kwargs):
-    locations = Location.objects.filter(
-        geom__intersects=(instance.geom))
-
-    for location in locations:
-        location.update_overlapping_greenbelt()
-        location.save()
+    from .nearest import refresh_greenbelt_overlap
+    refresh_greenbelt_overlap(greenbelt_ids=[instance.id])
 
 
 @receiver(post_delete, sender=Greenbelt, weak=False)
@@ -295,12 +240,18 @@ def greenbelt_postdelete_handler(sender, instance, **kwargs):
     Whenever we try to delete a Greenbelt, we check all the Locations
     overlapping it and we update their properties.
     """
-    locations = Location.objects.filter(
-        geom__intersects=instance.geom)
+    from .nearest import refresh_greenbelt_overlap
+    refresh_greenbelt_overlap(geoms=[instance.geom])
 
-    for location in locations:
-        location.update_overlapping_greenbelt()
-        location.save()
+
+class GreenbeltPart(models.Model):
+    # A piece of the geometry of a Greenbelt, in British National Grid,
+    # small enough for intersecting it with a Location to stay cheap
+    # (maintained by api.nearest.refresh_greenbelt_parts)
+
+    greenbelt = models.ForeignKey(
+        Greenbelt, on_delete=models.CASCADE, related_name='parts')
+    geom = models.GeometryField(srid=27700, spatial_index=True)
 
 
 class School(models.Model):
@@ -315,52 +266,28 @@ class School(models.Model):
     postcode = models.CharField(max_length=255, blank=True, null=True)
     point = models.PointField(geography=True, spatial_index=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.point, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.point))
-
-        for location in locations:
-            if self.school_type == 'PRIMARY':
-                if location.nearest_primary_school:
-                    if (
-                            location.distance.m >
-                            location.nearest_primary_school_distance):
-                        continue
-
-                location.nearest_primary_school = self
-                location.nearest_primary_school_distance = location.distance.m
-                location.save()
-            elif self.school_type == 'SECONDARY':
-                if location.nearest_secondary_school:
-                    if (
-                            location.distance.m >
-                            location.nearest_secondary_school_distance):
-                        continue
-
-                location.nearest_secondary_school = self
-                location.nearest_secondary_school_distance = \
-                    location.distance.m
-                location.save()
-
-
-@receiver(pre_delete, sender=School, weak=False)
-def school_predelete_handler(sender, instance, **kwargs):
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        if self.school_type == 'PRIMARY':
+            refresh_nearest(
+                'primary_school', amenity_ids=[self.id],
+                distance=default_range)
+        elif self.school_type == 'SECONDARY':
+            refresh_nearest(
+                'secondary_school', amenity_ids=[self.id],
+                distance=default_range)
+
+
+@receiver(post_delete, sender=School, weak=False)
+def school_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a School, we search all the Locations
-    using it and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a School, we point all the Locations which were
+    using it to their next closest primary and secondary schools, if there
+    are any in range.
     """
-    # Clean Primary schools
-    Location.objects.filter(nearest_primary_school__id=instance.id).\
-        update(
-            nearest_primary_school=None,
-            nearest_primary_school_distance=0)
-
-    # Clean Secondary schools
-    Location.objects.filter(nearest_secondary_school__id=instance.id).\
-        update(
-            nearest_secondary_school=None,
-            nearest_secondary_school_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('primary_school', [instance.id])
+    replace_nearest('secondary_school', [instance.id])
 
 
 class MetroTube(models.Model):
@@ -372,31 +299,20 @@ class MetroTube(models.Model):
     locality = models.CharField(max_length=255, blank=True, null=True)
     point = models.PointField(geography=True, spatial_index=True)
 
-    def update_close_locations(self, default_range=1000):
-        locations = Location.objects.filter(
-            geom__dwithin=(self.point, D(m=default_range))).\
-            annotate(distance=Distance('geom', self.point))
-
-        for location in locations:
-            if location.nearest_metrotube:
-                if location.distance.m > location.nearest_metrotube_distance:
-                    continue
-
-            location.nearest_metrotube = self
-            location.nearest_metrotube_distance = location.distance.m
-            location.save()
+    def update_close_locations(self, default_range=None):
+        from .nearest import refresh_nearest
+        refresh_nearest(
+            'metrotube', amenity_ids=[self.id], distance=default_range)
 
 
-@receiver(pre_delete, sender=MetroTube, weak=False)
-def metrotube_predelete_handler(sender, instance, **kwargs):
+@receiver(post_delete, sender=MetroTube, weak=False)
+def metrotube_postdelete_handler(sender, instance, **kwargs):
     """
-    Whenever we try to delete a MetroTube, we search all the Locations
-    using it and we remove the reference, so the object can be safely deleted.
+    Whenever we delete a MetroTube, we point all the Locations which were
+    using it to their next closest one, if there is one in range.
     """
-    Location.objects.filter(nearest_metrotube__id=instance.id).\
-        update(
-            nearest_metrotube=None,
-            nearest_metrotube_distance=0)
+    from .nearest import replace_nearest
+    replace_nearest('metrotube', [instance.id])
 
 
 class Location(models.Model):
@@ -413,151 +329,104 @@ class Location(models.Model):
     full_address = models.CharField(max_length=255, blank=True, null=True)
     estimated_floor_space = models.DecimalField(
         max_digits=16, decimal_places=2, null=True)
+    site_size = models.FloatField(null=True, db_index=True)  # m^2
+    # the post_delete handlers of the amenities replace the references to
+    # them, so the references aren't set to null on delete
     nearest_busstop = models.ForeignKey(
-        BusStop, on_delete=models.SET_NULL, null=True)
+        BusStop, on_delete=models.DO_NOTHING, null=True)
     nearest_busstop_distance = models.FloatField(null=True)  # meters
     nearest_trainstop = models.ForeignKey(
-        TrainStop, on_delete=models.SET_NULL, null=True)
+        TrainStop, on_delete=models.DO_NOTHING, null=True)
     nearest_trainstop_distance = models.FloatField(null=True)  # meters
     nearest_substation = models.ForeignKey(
-        Substation, on_delete=models.SET_NULL, null=True)
+        Substation, on_delete=models.DO_NOTHING, null=True)
     nearest_substation_distance = models.FloatField(null=True)  # meters
     nearest_ohl = models.ForeignKey(
-        OverheadLine, on_delete=models.SET_NULL, null=True)
+        OverheadLine, on_delete=models.DO_NOTHING, null=True)
     nearest_ohl_distance = models.FloatField(null=True)  # meters
     nearest_motorway = models.ForeignKey(
-        Motorway, on_delete=models.SET_NULL, null=True)
+        Motorway, on_delete=models.DO_NOTHING, null=True)
     nearest_motorway_distance = models.FloatField(null=True)  # meters
     nearest_broadband = models.ForeignKey(
-        Broadband, on_delete=models.SET_NULL, null=True)
+        Broadband, on_delete=models.DO_NOTHING, null=True)
     nearest_broadband_distance = models.FloatField(null=True)  # meters
     nearest_broadband_fast = models.NullBooleanField()
     greenbelt_overlap = models.NullBooleanField(null=True)
+    # the proportion (0 to 1) of the area overlapping a greenbelt
+    greenbelt_overlap_ratio = models.FloatField(null=True)
     nearest_primary_school = models.ForeignKey(
-        School, on_delete=models.SET_NULL, null=True,
+        School, on_delete=models.DO_NOTHING, null=True,
         related_name='primary_school_locations')
     nearest_primary_school_distance = models.FloatField(null=True)  # meters
     nearest_secondary_school = models.ForeignKey(
-        School, on_delete=models.SET_NULL, null=True,
+        School, on_delete=models.DO_NOTHING, null=True,
         related_name='secondary_school_locations')
     nearest_secondary_school_distance = models.FloatField(null=True)  # meters
     nearest_metrotube = models.ForeignKey(
-        MetroTube, on_delete=models.SET_NULL, null=True)
+        MetroTube, on_delete=models.DO_NOTHING, null=True)
     nearest_metrotube_distance = models.FloatField(null=True)  # meters
 
-    def update_nearest_busstop(self, distance=1000):
-        bss = BusStop.objects.filter(
-            point__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
+    def update_nearest(self, name, distance=None):
+        '''Sets nearest_<name> (and its distance) to the closest amenity
+        within `distance` meters, if there is one.
+        '''
+        from .nearest import get_amenity, find_nearest
+        nearest = find_nearest(name, self.geom, distance)
 
-        if len(bss) > 0:
-            self.nearest_busstop = bss[0]
-            self.nearest_busstop_distance = bss[0].distance.m
+        if nearest is not None:
+            setattr(self, 'nearest_' + name, nearest)
+            setattr(self, 'nearest_{0}_distance'.format(name),
+                    nearest.distance)
+            for column, expression in get_amenity(name).extra:
+                setattr(self, column, getattr(nearest, column))
 
-    def update_nearest_trainstop(self, distance=1000):
-        tss = TrainStop.objects.filter(
-            point__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
+    def update_nearest_busstop(self, distance=1000):
+        self.update_nearest('busstop', distance)
 
-        if len(tss) > 0:
-            self.nearest_trainstop = tss[0]
-            self.nearest_trainstop_distance = tss[0].distance.m
+    def update_nearest_trainstop(self, distance=1000):
+        self.update_nearest('trainstop', distance)
 
     def update_nearest_substation(self, distance=1000):
-        sss = Substation.objects.filter(
-            geom__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('geom', self.geom)).order_by('distance')
-
-        if len(sss) > 0:
-            self.nearest_substation = sss[0]
-            self.nearest_substation_distance = sss[0].distance.m
+        self.update_nearest('substation', distance)
 
     def update_nearest_overheadline(self, distance=3000):
-        oh_lines = OverheadLine.objects.filter(
-            geom__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('geom', self.geom)).order_by('distance')
-
-        if len(oh_lines) > 0:
-            self.nearest_ohl = oh_lines[0]
-            self.nearest_ohl_distance = oh_lines[0].distance.m
+        self.update_nearest('ohl', distance)
 
     def update_nearest_motorway(self, distance=6000):
-        motorways = Motorway.objects.filter(
-            point__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
-
-        if len(motorways) > 0:
-            self.nearest_motorway = motorways[0]
-            self.nearest_motorway_distance = motorways[0].distance.m
+        self.update_nearest('motorway', distance)
 
     def update_nearest_broadband(self, distance=500):
-        broadbands = Broadband.objects.filter(
-            point__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
-
-        if len(broadbands) > 0:
-            self.nearest_broadband = broadbands[0]
-            self.nearest_broadband_distance = broadbands[0].distance.m
-            if broadbands[0].speed_30_mb_percentage > 0:
-                self.nearest_broadband_fast = True
+        self.update_nearest('broadband', distance)
 
     def update_overlapping_greenbelt(self):
-        intersects = Greenbelt.objects \
-            .filter(geom__intersects=(self.geom)) \
-            .all()[:1]
-        self.greenbelt_overlap = bool(intersects)
-        # Ideally we'd calculate the proportion that intersects, but
-        # that is hard. This is how far I got, but the geography needs
-        # converting to 2D somehow:
-        #     .annotate(geom_=Cast('geom', models.MultiPolygonField())) \
-        # intersection_area = Greenbelt.objects \
-        #     .filter(geom__intersects=(self.geom)) \
-        #     .annotate(geom_=Cast('geom', models.MultiPolygonField())) \
-        #     .aggregate(area=models.Union('geom_'))['area']
-        # proportion_overlap_with_greenbelt = intersection_area / self.geom.area
-        # self.greenbelt_overlap = proportion_overlap_with_greenbelt
+        '''Sets greenbelt_overlap, and the proportion of the area
+        overlapping a greenbelt (greenbelt_overlap_ratio).
+        '''
+        from .nearest import greenbelt_overlap
+        self.greenbelt_overlap, self.greenbelt_overlap_ratio = \
+            greenbelt_overlap(self.geom)
 
     def update_nearest_primary_school(self, distance=1000):
-        schools = School.objects.filter(
-            point__dwithin=(self.geom, D(m=distance)),
-            school_type='PRIMARY').annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
-
-        if len(schools) > 0:
-            self.nearest_primary_school = schools[0]
-            self.nearest_primary_school_distance = schools[0].distance.m
+        self.update_nearest('primary_school', distance)
 
     def update_nearest_secondary_school(self, distance=1000):
-        schools = School.objects.filter(
-            point__dwithin=(self.geom, D(m=distance)),
-            school_type='SECONDARY').annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
-
-        if len(schools) > 0:
-            self.nearest_secondary_school = schools[0]
-            self.nearest_secondary_school_distance = schools[0].distance.m
+        self.update_nearest('secondary_school', distance)
 
     def update_nearest_metrotube(self, distance=1000):
-        metrotubes = MetroTube.objects.filter(
-            point__dwithin=(self.geom, D(m=distance))).annotate(
-            distance=Distance('point', self.geom)).order_by('distance')
-
-        if len(metrotubes) > 0:
-            self.nearest_metrotube = metrotubes[0]
-            self.nearest_metrotube_distance = metrotubes[0].distance.m
+        self.update_nearest('metrotube', distance)
 
     def save(self, *args, **kwargs):
-        if self.pk is None:
-            self.update_nearest_busstop()
-            self.update_nearest_trainstop()
-            self.update_nearest_substation()
-            self.update_nearest_overheadline()
-            self.update_nearest_motorway()
-            self.update_nearest_broadband()
-            self.update_overlapping_greenbelt()
-            self.update_nearest_primary_school()
-            self.update_nearest_secondary_school()
-            self.update_nearest_metrotube()
+        # Callers that have already enriched the location (e.g. a batch
+        # through api.nearest.enrich_locations) can skip it with enrich=False
+        enrich = kwargs.pop('enrich', True)
+
+        if self.pk is None and enrich:
+            from .nearest import enrich_locations
+            enrich_locations([self])
+
+        # Keep the stored area in line with the geometry
+        if self.geom is not None:
+            self.site_size = self.get_geom_area()
 
         super(Location, self).save(*args, **kwargs)
 
@@ -588,3 +457,63 @@ class Location(models.Model):
         # created with) to British National Grid SRID of 27700 because that
         # uses meters as the units.
         return abs(self.geom.transform(27700, clone=True).area)
+
+
+class DatasetVersion(object):
+    # A counter bumped whenever the Locations or the amenities change, which
+    # versions the cached location searches. It is a sequence rather than a
+    # row, so that concurrent writers don't wait on (or deadlock over) it.
+
+    sequence = 'api_datasetversion_seq'
+
+    # the bumps not yet applied, in this thread's transaction
+    _pending = threading.local()
+
+    @classmethod
+    def current(cls):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT CASE WHEN is_called THEN last_value ELSE 0 END '
+                'FROM {0}'.format(connection.ops.quote_name(cls.sequence)))
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def bump(cls):
+        '''Increments the version once the current transaction commits
+        (straight away outside of one), and only once per transaction.
+        '''
+        cls._pending.count = getattr(cls._pending, 'count', 0) + 1
+        transaction.on_commit(cls.increment)
+
+    @classmethod
+    def increment(cls):
+        # The first of the callbacks of a transaction applies all of its
+        # bumps (and those left by a rolled back one, which is harmless)
+        if not getattr(cls._pending, 'count', 0):
+            return
+        cls._pending.count = 0
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(%s)', [cls.sequence])
+
+
+# The models the location searches depend on
+DATASET_MODELS = (
+    Location, CodePoint, BusStop, TrainStop, Substation, OverheadLine,
+    Motorway, Broadband, Greenbelt, School, MetroTube)
+
+
+def dataset_changed_handler(sender, **kwargs):
+    """
+    Whenever a Location or an amenity is saved or deleted, we bump the
+    DatasetVersion. (Bulk writes bump it once themselves, and flag the
+    signals they send with bulk=True.)
+    """
+    if not kwargs.get('bulk'):
+        DatasetVersion.bump()
+
+
+for dataset_model in DATASET_MODELS:
+    post_save.connect(
+        dataset_changed_handler, sender=dataset_model, weak=False)
+    post_delete.connect(
+        dataset_changed_handler, sender=dataset_model, weak=False)
@@ -0,0 +1,656 @@
+'''Set-based maintenance of the nearest_<amenity> columns on Location.
+
+Rather than loading every Location close to an amenity and saving them one
+at a time, the nearest amenity for a batch of locations is resolved and
+written by a single UPDATE, using a lateral nearest-neighbour join against
+the amenity's spatial index. The same nearest-neighbour query is used to
+look up the closest amenity of a single geometry. The greenbelt_overlap of
+the Locations around changed Greenbelts is recomputed the same way.
+'''
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import threading
+
+from django.db import connection
+
+from .models import (
+    BusStop, TrainStop, Substation, OverheadLine, Motorway, Broadband,
+    Greenbelt, GreenbeltPart, School, MetroTube, Location, DatasetVersion)
+
+log = __import__('logging').getLogger(__name__)
+
+# Number of Location rows resolved by each UPDATE statement
+BATCH_SIZE = 5000
+
+# Number of Locations enriched by each query of enrich_locations
+ENRICH_BATCH_SIZE = 500
+
+# Greenbelts are subdivided (as GreenbeltParts) into pieces of at most this
+# many vertices
+SUBDIVIDE_MAX_VERTICES = 256
+
+# The SRID areas are measured in: British National Grid, in meters
+AREA_SRID = 27700
+
+# Number of candidates taken from the spatial index, in `<->` order, before
+# re-checking their exact distance
+KNN_CANDIDATES = 8
+
+
+# name: the suffix used by the Location columns, e.g. nearest_<name>
+# geom_field: the amenity field measured against Location.geom
+# default_range: search radius in meters (as used by Location.save)
+# filters: extra equality conditions on the amenity table
+# extra: additional (location column, SQL expression on the amenity) pairs
+NearestAmenity = namedtuple(
+    'NearestAmenity',
+    ['name', 'model', 'geom_field', 'default_range', 'filters', 'extra'])
+
+AMENITIES = (
+    NearestAmenity('busstop', BusStop, 'point', 1000, (), ()),
+    NearestAmenity('trainstop', TrainStop, 'point', 1000, (), ()),
+    NearestAmenity('substation', Substation, 'geom', 1000, (), ()),
+    NearestAmenity('ohl', OverheadLine, 'geom', 3000, (), ()),
+    NearestAmenity('motorway', Motorway, 'point', 6000, (), ()),
+    NearestAmenity(
+        'broadband', Broadband, 'point', 500, (),
+        (('nearest_broadband_fast', '{alias}.speed_30_mb_percentage > 0'),)),
+    NearestAmenity(
+        'primary_school', School, 'point', 1000,
+        (('school_type', 'PRIMARY'),), ()),
+    NearestAmenity(
+        'secondary_school', School, 'point', 1000,
+        (('school_type', 'SECONDARY'),), ()),
+    NearestAmenity('metrotube', MetroTube, 'point', 1000, (), ()),
+)
+
+AMENITIES_BY_NAME = dict((amenity.name, amenity) for amenity in AMENITIES)
+
+# Values of the extra columns of a Location without any amenity in range
+EMPTY_EXTRA = {'nearest_broadband_fast': False}
+
+# Name under which deferred_refresh records the changed Greenbelts
+GREENBELT = 'greenbelt'
+
+# Amenities (and Greenbelts) recorded by refresh_nearest (and
+# refresh_greenbelt_overlap) within a deferred_refresh block
+_deferred = threading.local()
+
+
+def get_amenity(name):
+    try:
+        return AMENITIES_BY_NAME[name]
+    except KeyError:
+        raise ValueError('Unknown amenity: {0}'.format(name))
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def _column(model, field_name):
+    return _quote(model._meta.get_field(field_name).column)
+
+
+def geography_param(geom):
+    '''Returns a GEOS geometry as a parameter for a `%s::geography`
+    placeholder.
+    '''
+    if geom.srid and geom.srid != 4326:
+        geom = geom.transform(4326, clone=True)
+    hexewkb = geom.hexewkb
+    if isinstance(hexewkb, bytes):
+        hexewkb = hexewkb.decode()
+    return hexewkb
+
+
+def nearest_amenity_sql(amenity, location_geom, columns='c.id'):
+    '''Returns (sql, params) for a query selecting the closest amenity to
+    `location_geom` (an SQL expression) within the amenity's search radius,
+    with its `distance` in meters and any extra columns of the amenity spec.
+
+    The candidates are taken from the spatial index in `<->` order, then
+    re-checked against the exact (spheroid) distance, as the index ordering
+    is only approximate.
+    The search radius is left as the first placeholder, so callers can
+    supply their own.
+    '''
+    geom = _column(amenity.model, amenity.geom_field)
+    conditions = ['ST_DWithin(c.{0}, {1}, %s)'.format(geom, location_geom)]
+    params = []
+    for field_name, value in amenity.filters:
+        conditions.append(
+            'c.{0} = %s'.format(_column(amenity.model, field_name)))
+        params.append(value)
+
+    extra_columns = ''.join(
+        ', {0} AS {1}'.format(expression.format(alias='c'), _quote(column))
+        for column, expression in amenity.extra)
+
+    sql = (
+        'SELECT * FROM ('
+        'SELECT {columns}, ST_Distance(c.{geom}, {location_geom}) AS distance'
+        '{extra_columns} '
+        'FROM {table} AS c '
+        'WHERE {conditions} '
+        'ORDER BY c.{geom} <-> {location_geom} '
+        'LIMIT {candidates}'
+        ') AS candidates '
+        'ORDER BY distance, id '
+        'LIMIT 1').format(
+            columns=columns,
+            geom=geom,
+            location_geom=location_geom,
+            extra_columns=extra_columns,
+            table=_quote(amenity.model._meta.db_table),
+            conditions=' AND '.join(conditions),
+            candidates=KNN_CANDIDATES)
+
+    return sql, params
+
+
+def nearest_amenity_lateral(amenity, location_geom, alias='a'):
+    '''Same as nearest_amenity_sql, as a LATERAL subquery named `alias`.
+    '''
+    sql, params = nearest_amenity_sql(amenity, location_geom)
+    return 'LATERAL ({0}) AS {1}'.format(sql, alias), params
+
+
+def find_nearest(name, geom, distance=None):
+    '''Returns the amenity closest to the geometry `geom`, annotated with its
+    `distance` in meters (and any extra column of the amenity spec), or None
+    if there is no amenity within `distance`.
+    '''
+    amenity = get_amenity(name)
+    if distance is None:
+        distance = amenity.default_range
+
+    sql, params = nearest_amenity_sql(amenity, 'src.geom', columns='c.*')
+    sql = (
+        'SELECT n.* FROM (SELECT %s::geography AS geom) AS src '
+        'CROSS JOIN LATERAL ({0}) AS n').format(sql)
+
+    for nearest in amenity.model.objects.raw(
+            sql, [geography_param(geom), distance] + params):
+        return nearest
+    return None
+
+
+def _set_nearest(location, amenity, amenity_id, distance, extra):
+    fk_field = Location._meta.get_field('nearest_' + amenity.name)
+    if getattr(location, fk_field.attname) != amenity_id:
+        # drop any stale related object cached on the instance
+        location.__dict__.pop(fk_field.get_cache_name(), None)
+        setattr(location, fk_field.attname, amenity_id)
+    setattr(location, 'nearest_{0}_distance'.format(amenity.name), distance)
+    for (column, expression), value in zip(amenity.extra, extra):
+        setattr(location, column, value)
+
+
+def greenbelt_overlap_sql(location_geom):
+    '''Returns the SQL expressions of whether `location_geom` (an SQL
+    geography expression) intersects a Greenbelt, and of the proportion
+    (0 to 1) of its area overlapping Greenbelts.
+
+    The area is measured in AREA_SRID, against the GreenbeltParts, so that
+    only the small pieces of the Greenbelts around the location are
+    intersected with it, rather than whole (huge) multipolygons.
+    '''
+    overlap = (
+        'EXISTS (SELECT 1 FROM {0} AS g '
+        'WHERE ST_Intersects(g.{1}, {2}))').format(
+            _quote(Greenbelt._meta.db_table), _column(Greenbelt, 'geom'),
+            location_geom)
+
+    projected = 'ST_Transform({0}::geometry, {1})'.format(
+        location_geom, AREA_SRID)
+    # the parts of overlapping Greenbelts can overlap, hence the union (of
+    # the polygons of the intersections, as parts that only touch the
+    # location intersect it in lines or points)
+    ratio = (
+        'LEAST(1.0, COALESCE(('
+        'SELECT ST_Area(ST_Union(ST_CollectionExtract('
+        'ST_Intersection(p.{geom}, {projected}), 3))) '
+        'FROM {table} AS p WHERE ST_Intersects(p.{geom}, {projected})'
+        ') / NULLIF(ST_Area({projected}), 0), 0))').format(
+            geom=_column(GreenbeltPart, 'geom'),
+            projected=projected,
+            table=_quote(GreenbeltPart._meta.db_table))
+
+    return overlap, ratio
+
+
+def greenbelt_overlap(geom):
+    '''Returns whether the geometry `geom` intersects a Greenbelt, and the
+    proportion (0 to 1) of its area overlapping Greenbelts.
+    '''
+    sql = 'SELECT {0}, {1} FROM (SELECT %s::geography AS geom) AS src'.format(
+        *greenbelt_overlap_sql('src.geom'))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [geography_param(geom)])
+        return cursor.fetchone()
+
+
+def _enrich_batch(locations):
+    params = []
+    values = []
+    for i, location in enumerate(locations):
+        values.append('(%s, %s::geography)')
+        params.extend([i, geography_param(location.geom)])
+
+    columns = ['src.ord']
+    joins = []
+    for amenity in AMENITIES:
+        alias = _quote(amenity.name)
+        sql, amenity_params = nearest_amenity_sql(amenity, 'src.geom')
+        joins.append(
+            'LEFT JOIN LATERAL ({0}) AS {1} ON true'.format(sql, alias))
+        params.extend([amenity.default_range] + amenity_params)
+        columns.append('{0}.id'.format(alias))
+        columns.append('{0}.distance'.format(alias))
+        columns.extend(
+            '{0}.{1}'.format(alias, _quote(column))
+            for column, expression in amenity.extra)
+
+    columns.extend(greenbelt_overlap_sql('src.geom'))
+
+    sql = (
+        'SELECT {columns} '
+        'FROM (VALUES {values}) AS src(ord, geom) '
+        '{joins} '
+        'ORDER BY src.ord').format(
+            columns=', '.join(columns),
+            values=', '.join(values),
+            joins=' '.join(joins))
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    for row in rows:
+        location = locations[row[0]]
+        i = 1
+        for amenity in AMENITIES:
+            amenity_id, distance = row[i], row[i + 1]
+            extra = row[i + 2:i + 2 + len(amenity.extra)]
+            i += 2 + len(amenity.extra)
+            if amenity_id is not None:
+                _set_nearest(location, amenity, amenity_id, distance, extra)
+        location.greenbelt_overlap = row[i]
+        location.greenbelt_overlap_ratio = row[i + 1]
+
+
+def enrich_locations(locations, batch_size=ENRICH_BATCH_SIZE):
+    '''Resolves the nearest amenities (each within its own search radius)
+    and the greenbelt overlap of the given Locations, with a single query
+    per batch, and sets them on the objects without saving them.
+    An amenity that isn't found in range leaves the current value untouched,
+    like the update_nearest_* methods of Location do.
+    '''
+    locations = list(locations)
+    for i in range(0, len(locations), batch_size):
+        _enrich_batch(locations[i:i + batch_size])
+
+
+def _nearest_values(amenity):
+    '''Returns the (location column, SQL expression) pairs, and the params
+    of the expressions, setting nearest_<name> from the row `n` of a LEFT
+    JOIN against nearest_amenity_lateral: to no amenity (with a distance of
+    0) when none is in range.
+    '''
+    values = [
+        (_column(Location, 'nearest_' + amenity.name), 'n.id'),
+        (_column(Location, 'nearest_{0}_distance'.format(amenity.name)),
+         'COALESCE(n.distance, 0)'),
+    ]
+    params = []
+    for column, expression in amenity.extra:
+        values.append(
+            (_quote(column), 'COALESCE(n.{0}, %s)'.format(_quote(column))))
+        params.append(EMPTY_EXTRA.get(column))
+    return values, params
+
+
+def _update_batch(amenity, location_ids, distance):
+    '''Recompute the nearest amenity for the given Location ids with a single
+    UPDATE. Locations with no amenity in range are set to none (e.g. when
+    the one they had moved away), as replace_nearest does. The ones whose
+    nearest amenity hasn't changed are left untouched.
+    '''
+    location_table = _quote(Location._meta.db_table)
+    values, values_params = _nearest_values(amenity)
+
+    lateral, lateral_params = nearest_amenity_lateral(amenity, 'src.geom')
+
+    sql = (
+        'UPDATE {location_table} AS l '
+        'SET {assignments} '
+        'FROM ('
+        'SELECT src.id AS location_id, a.* '
+        'FROM {location_table} AS src LEFT JOIN {lateral} ON true '
+        'WHERE src.id = ANY(%s)'
+        ') AS n '
+        'WHERE l.id = n.location_id AND ({changed})').format(
+            location_table=location_table,
+            assignments=', '.join(
+                '{0} = {1}'.format(column, expression)
+                for column, expression in values),
+            lateral=lateral,
+            changed=' OR '.join(
+                'l.{0} IS DISTINCT FROM {1}'.format(column, expression)
+                for column, expression in values))
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql, values_params + [distance] + lateral_params + [location_ids] +
+            values_params)
+        return cursor.rowcount
+
+
+def replace_nearest(name, amenity_ids, distance=None):
+    '''Points the Locations referencing any of the given (deleted) amenities
+    at their closest remaining amenity within `distance`, or at none (with a
+    distance of 0) if there isn't one, with a single UPDATE.
+    `distance` defaults to the amenity's search radius.
+    Returns the number of Location rows updated.
+    '''
+    amenity = get_amenity(name)
+    if distance is None:
+        distance = amenity.default_range
+    amenity_ids = list(amenity_ids)
+    if not amenity_ids:
+        return 0
+
+    location_table = _quote(Location._meta.db_table)
+    fk_column = _column(Location, 'nearest_' + amenity.name)
+    values, params = _nearest_values(amenity)
+
+    lateral, lateral_params = nearest_amenity_lateral(amenity, 'src.geom')
+
+    sql = (
+        'UPDATE {location_table} AS l '
+        'SET {assignments} '
+        'FROM ('
+        'SELECT src.id AS location_id, a.* '
+        'FROM {location_table} AS src LEFT JOIN {lateral} ON true '
+        'WHERE src.{fk_column} = ANY(%s)'
+        ') AS n '
+        'WHERE l.id = n.location_id').format(
+            location_table=location_table,
+            assignments=', '.join(
+                '{0} = {1}'.format(column, expression)
+                for column, expression in values),
+            lateral=lateral,
+            fk_column=fk_column)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql, params + [distance] + lateral_params + [amenity_ids])
+        updated = cursor.rowcount
+
+    log.debug('Replaced nearest %s on %s locations', name, updated)
+    return updated
+
+
+def _all_location_batches(batch_size):
+    '''Yields lists of Location ids, in id order, without loading them all
+    in memory at once.
+    '''
+    last_id = 0
+    while True:
+        ids = list(
+            Location.objects.filter(id__gt=last_id).order_by('id').
+            values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def _locations_close_to(amenity, amenity_ids, distance):
+    '''Returns the ids of the Locations within `distance` of any of the given
+    amenities, or currently referencing one of them.
+    '''
+    geom = _column(amenity.model, amenity.geom_field)
+    sql = (
+        'SELECT l.id FROM {location_table} AS l '
+        'JOIN {table} AS c ON ST_DWithin(c.{geom}, l.geom, %s) '
+        'WHERE c.id = ANY(%s) '
+        'UNION '
+        'SELECT l.id FROM {location_table} AS l '
+        'WHERE l.{fk_column} = ANY(%s) '
+        'ORDER BY 1').format(
+            location_table=_quote(Location._meta.db_table),
+            table=_quote(amenity.model._meta.db_table),
+            geom=geom,
+            fk_column=_column(Location, 'nearest_' + amenity.name))
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [distance, amenity_ids, amenity_ids])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def refresh_nearest(name, amenity_ids=None, distance=None,
+                    batch_size=BATCH_SIZE):
+    '''Recompute nearest_<name> and nearest_<name>_distance on Location.
+
+    If `amenity_ids` is given, only the Locations within `distance` of those
+    amenities (or referencing them) are refreshed, otherwise every Location
+    is. `distance` defaults to the amenity's search radius.
+    Returns the number of Location rows that changed.
+
+    Within a deferred_refresh block, the amenity ids are only recorded.
+    '''
+    amenity = get_amenity(name)
+    if distance is None:
+        distance = amenity.default_range
+
+    pending = getattr(_deferred, 'pending', None)
+    if amenity_ids is not None and pending is not None:
+        pending.setdefault((name, distance), set()).update(amenity_ids)
+        return 0
+
+    if amenity_ids is None:
+        batches = _all_location_batches(batch_size)
+    else:
+        amenity_ids = list(amenity_ids)
+        if not amenity_ids:
+            return 0
+        location_ids = _locations_close_to(amenity, amenity_ids, distance)
+        batches = (
+            location_ids[i:i + batch_size]
+            for i in range(0, len(location_ids), batch_size))
+
+    updated = 0
+    for location_ids in batches:
+        updated += _update_batch(amenity, location_ids, distance)
+    if updated:
+        DatasetVersion.bump()
+
+    log.debug('Refreshed nearest %s on %s locations', name, updated)
+    return updated
+
+
+def refresh_greenbelt_parts(greenbelt_ids=None):
+    '''Rebuilds the GreenbeltParts of the given Greenbelts (or of all of
+    them): their geometry in AREA_SRID, subdivided into pieces of at most
+    SUBDIVIDE_MAX_VERTICES vertices.
+    '''
+    part_table = _quote(GreenbeltPart._meta.db_table)
+    greenbelt_column = _column(GreenbeltPart, 'greenbelt')
+
+    delete_sql = 'DELETE FROM {0}'.format(part_table)
+    insert_sql = (
+        'INSERT INTO {0} ({1}, {2}) '
+        'SELECT g.id, ST_Subdivide(ST_Transform(g.{3}::geometry, {4}), %s) '
+        'FROM {5} AS g').format(
+            part_table, greenbelt_column, _column(GreenbeltPart, 'geom'),
+            _column(Greenbelt, 'geom'), AREA_SRID,
+            _quote(Greenbelt._meta.db_table))
+    delete_params = []
+    insert_params = [SUBDIVIDE_MAX_VERTICES]
+    if greenbelt_ids is not None:
+        delete_sql += ' WHERE {0} = ANY(%s)'.format(greenbelt_column)
+        insert_sql += ' WHERE g.id = ANY(%s)'
+        delete_params.append(greenbelt_ids)
+        insert_params.append(greenbelt_ids)
+
+    with connection.cursor() as cursor:
+        cursor.execute(delete_sql, delete_params)
+        cursor.execute(insert_sql, insert_params)
+        return cursor.rowcount
+
+
+def refresh_greenbelt_overlap(greenbelt_ids=None, geoms=()):
+    '''Recompute greenbelt_overlap and greenbelt_overlap_ratio on Location
+    with a single UPDATE, after rebuilding the GreenbeltParts of the given
+    Greenbelts.
+
+    Only the Locations whose bounding box overlaps one of the given
+    Greenbelts, or one of the geometries `geoms` (e.g. of deleted
+    Greenbelts), are refreshed. Without either, every Location is (and every
+    GreenbeltPart is rebuilt).
+    Returns the number of Location rows that changed.
+
+    Within a deferred_refresh block, the Greenbelt ids are only recorded.
+    '''
+    pending = getattr(_deferred, 'pending', None)
+    if greenbelt_ids is not None and not geoms and pending is not None:
+        pending.setdefault((GREENBELT, None), set()).update(greenbelt_ids)
+        return 0
+
+    if greenbelt_ids is not None:
+        greenbelt_ids = list(greenbelt_ids)
+    if greenbelt_ids or (greenbelt_ids is None and not geoms):
+        refresh_greenbelt_parts(greenbelt_ids)
+
+    location_table = _quote(Location._meta.db_table)
+    overlap_column = _column(Location, 'greenbelt_overlap')
+    ratio_column = _column(Location, 'greenbelt_overlap_ratio')
+
+    areas = []
+    params = []
+    if greenbelt_ids:
+        areas.append(
+            'EXISTS (SELECT 1 FROM {0} AS b '
+            'WHERE b.id = ANY(%s) AND b.{1} && src.geom)'.format(
+                _quote(Greenbelt._meta.db_table),
+                _column(Greenbelt, 'geom')))
+        params.append(greenbelt_ids)
+    for area in geoms:
+        areas.append('src.geom && %s::geography')
+        params.append(geography_param(area))
+    if not areas and (greenbelt_ids is not None or geoms):
+        return 0
+
+    overlap, ratio = greenbelt_overlap_sql('src.geom')
+    sql = (
+        'UPDATE {location_table} AS l '
+        'SET {overlap_column} = n.overlap, {ratio_column} = n.ratio '
+        'FROM ('
+        'SELECT src.id AS location_id, {overlap} AS overlap, {ratio} AS ratio '
+        'FROM {location_table} AS src{where}'
+        ') AS n '
+        'WHERE l.id = n.location_id AND ('
+        'l.{overlap_column} IS DISTINCT FROM n.overlap OR '
+        'l.{ratio_column} IS DISTINCT FROM n.ratio)').format(
+            location_table=location_table,
+            overlap_column=overlap_column,
+            ratio_column=ratio_column,
+            where=' WHERE ' + ' OR '.join(areas) if areas else '',
+            overlap=overlap,
+            ratio=ratio)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        updated = cursor.rowcount
+    if updated:
+        DatasetVersion.bump()
+
+    log.debug('Refreshed greenbelt overlap on %s locations', updated)
+    return updated
+
+
+def _refresh_pending(pending):
+    for (name, distance), ids in pending.items():
+        if name == GREENBELT:
+            refresh_greenbelt_overlap(greenbelt_ids=sorted(ids))
+        else:
+            refresh_nearest(name, amenity_ids=sorted(ids), distance=distance)
+
+
+def amenity_names(obj):
+    '''Returns the names of the amenities an amenity instance (e.g. a BusStop
+    or a School) counts as.
+    '''
+    return [
+        amenity.name for amenity in AMENITIES
+        if isinstance(obj, amenity.model) and all(
+            getattr(obj, field_name) == value
+            for field_name, value in amenity.filters)]
+
+
+def refresh_nearest_for(objs, distance=None):
+    '''Refreshes the Locations close to the given (saved) amenity instances,
+    with one refresh_nearest per amenity type rather than one per instance.
+    '''
+    ids_by_name = {}
+    for obj in objs:
+        for name in amenity_names(obj):
+            ids_by_name.setdefault(name, set()).add(obj.pk)
+
+    updated = 0
+    for amenity in AMENITIES:
+        if amenity.name in ids_by_name:
+            updated += refresh_nearest(
+                amenity.name, amenity_ids=sorted(ids_by_name[amenity.name]),
+                distance=distance)
+    return updated
+
+
+@contextmanager
+def deferred_refresh(enabled=True):
+    '''Within this block refresh_nearest (and so update_close_locations) and
+    refresh_greenbelt_overlap only record which amenities (and Greenbelts)
+    changed. They are refreshed together when the outermost block exits, so
+    that a Location close to many of them is written once, rather than once
+    per amenity.
+    '''
+    if not enabled or getattr(_deferred, 'pending', None) is not None:
+        yield
+        return
+
+    _deferred.pending = OrderedDict()
+    try:
+        yield
+    except BaseException:
+        pending, _deferred.pending = _deferred.pending, None
+        # Within a transaction the changes are rolled back (and the
+        # transaction may be aborted), so there is nothing to refresh, but
+        # outside of one the batches committed before the failure still
+        # need it (e.g. an import that stopped half way)
+        if not connection.in_atomic_block:
+            _refresh_pending(pending)
+        raise
+
+    pending, _deferred.pending = _deferred.pending, None
+    _refresh_pending(pending)
+
+
+def pop_deferred():
+    '''Returns and forgets the amenities recorded so far by the enclosing
+    deferred_refresh block, or None outside of one. Used by worker processes
+    to hand them over to the process that owns the block.
+    '''
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        _deferred.pending = OrderedDict()
+    return pending
+
+
+def extend_deferred(pending):
+    '''Records the amenities returned by pop_deferred (in another process)
+    in the enclosing deferred_refresh block, or refreshes them straight away
+    outside of one.
+    '''
+    _refresh_pending(pending)
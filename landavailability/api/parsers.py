@@ -0,0 +1,27 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    '''Parses newline delimited JSON (one object per line) into a list.'''
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        records = []
+        line_number = 0
+        try:
+            for line_number, line in enumerate(
+                    codecs.getreader(encoding)(stream), 1):
+                if line.strip():
+                    records.append(json.loads(line))
+        except ValueError as exc:
+            raise ParseError('NDJSON parse error on line {0} - {1}'.format(
+                line_number, exc))
+        return records
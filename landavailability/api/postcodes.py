@@ -0,0 +1,191 @@
+'''Resolves postcodes to the point of their CodePoint.
+
+Lookups go through, in order:
+    - the table loaded by preloaded_postcodes(), while one is in use (e.g.
+      by an import), which holds every CodePoint
+    - an in-process LRU of the last POSTCODE_CACHE_SIZE postcodes found
+    - the POSTCODE_CACHE cache backend, if one is set, shared between the
+      processes
+    - the database
+The postcodes not found are only cached in the shared cache, which every
+process forgets them from, so that a CodePoint created by another process
+is found straight away.
+Saving or deleting a CodePoint forgets its postcode, and
+forget_all_postcodes() forgets them all (after a bulk import).
+'''
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.db import connection
+
+from .models import CodePoint
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# the generation of the shared cache entries, bumped to forget them all
+GENERATION_KEY = 'postcodes:generation'
+
+# cached for postcodes without a CodePoint
+NOT_FOUND = ()
+
+_lock = threading.Lock()
+_lru = OrderedDict()
+_preloaded = threading.local()
+
+
+def normalise_postcode(postcode):
+    return postcode.strip().replace(' ', '').upper()
+
+
+class PostcodeTable(object):
+    '''The coordinates of many postcodes, kept as a sorted list of the
+    postcodes and arrays of their coordinates, which takes a fraction of the
+    memory of a dict of Points.
+    '''
+
+    def __init__(self, rows):
+        '''rows: (postcode, x, y) tuples, sorted by postcode.'''
+        self.postcodes = []
+        self.xs = array('d')
+        self.ys = array('d')
+        for postcode, x, y in rows:
+            self.postcodes.append(postcode)
+            self.xs.append(x)
+            self.ys.append(y)
+
+    def __len__(self):
+        return len(self.postcodes)
+
+    def get(self, postcode):
+        '''Returns the (x, y) of the postcode, or None.'''
+        i = bisect_left(self.postcodes, postcode)
+        if i < len(self.postcodes) and self.postcodes[i] == postcode:
+            return self.xs[i], self.ys[i]
+        return None
+
+    @classmethod
+    def load(cls):
+        '''Returns a table of all the CodePoints.'''
+        with connection.cursor() as cursor:
+            # ordered as Python compares strings, for bisect
+            cursor.execute(
+                'SELECT postcode, ST_X(point::geometry), '
+                'ST_Y(point::geometry) FROM {0} '
+                'ORDER BY postcode COLLATE "C"'.format(
+                    connection.ops.quote_name(CodePoint._meta.db_table)))
+            return cls(cursor)
+
+
+@contextmanager
+def preloaded_postcodes(enabled=True):
+    '''Loads all the CodePoints in memory, and resolves the postcodes with
+    them (without any query) until the end of the block. For imports that
+    look up many postcodes, while the CodePoints don't change.
+    '''
+    if not enabled or getattr(_preloaded, 'table', None) is not None:
+        yield
+        return
+
+    _preloaded.table = PostcodeTable.load()
+    log.info('Preloaded %s postcodes', len(_preloaded.table))
+    try:
+        yield
+    finally:
+        _preloaded.table = None
+
+
+def _shared_cache():
+    alias = getattr(settings, 'POSTCODE_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def _shared_key(cache, postcode):
+    return 'postcode:{0}:{1}'.format(
+        cache.get(GENERATION_KEY, 0), postcode)
+
+
+def _lookup(postcode):
+    '''Returns the (x, y) of a normalised postcode, or NOT_FOUND.'''
+    with _lock:
+        coords = _lru.get(postcode)
+        if coords is not None:
+            _lru.move_to_end(postcode)
+            return coords
+
+    cache = _shared_cache()
+    coords = None
+    if cache is not None:
+        key = _shared_key(cache, postcode)
+        coords = cache.get(key)
+
+    if coords is None:
+        point = CodePoint.objects.filter(postcode=postcode).values_list(
+            'point', flat=True).first()
+        coords = NOT_FOUND if point is None else (point.x, point.y)
+        if cache is not None:
+            cache.set(key, coords, getattr(
+                settings, 'POSTCODE_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT))
+
+    if coords == NOT_FOUND:
+        return coords
+
+    with _lock:
+        _lru[postcode] = coords
+        while len(_lru) > getattr(
+                settings, 'POSTCODE_CACHE_SIZE', DEFAULT_CACHE_SIZE):
+            _lru.popitem(last=False)
+    return coords
+
+
+def postcode_point(postcode):
+    '''Returns the Point of the CodePoint of a postcode (in any format), or
+    None if there isn't one.
+    '''
+    postcode = normalise_postcode(postcode)
+
+    table = getattr(_preloaded, 'table', None)
+    if table is not None:
+        coords = table.get(postcode) or NOT_FOUND
+    else:
+        coords = _lookup(postcode)
+
+    if coords == NOT_FOUND:
+        return None
+    return Point(coords[0], coords[1], srid=4326)
+
+
+def forget_postcode(postcode):
+    '''Forgets the cached point of a postcode, e.g. when its CodePoint
+    changes.
+    '''
+    postcode = normalise_postcode(postcode)
+    with _lock:
+        _lru.pop(postcode, None)
+
+    cache = _shared_cache()
+    if cache is not None:
+        cache.delete(_shared_key(cache, postcode))
+
+
+def forget_all_postcodes():
+    '''Forgets the cached point of every postcode, e.g. after a bulk import
+    of CodePoints.
+    '''
+    with _lock:
+        _lru.clear()
+
+    cache = _shared_cache()
+    if cache is not None:
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, 1, None)
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 
@@ -36,19 +38,58 @@ def school_site_size(num_pupils=0,
     return 0
 
 
+# The scoring columns taken from a Location, and the attribute holding each
+LOCATION_FEATURES = OrderedDict([
+    ('estimated_floor_space', 'estimated_floor_space'),
+    ('geoattributes.BROADBAND', 'nearest_broadband_fast'),
+    ('greenbelt overlap', 'greenbelt_overlap'),
+    ('geoattributes.DISTANCE TO BUS STOP', 'nearest_busstop_distance'),
+    ('geoattributes.DISTANCE TO METRO STATION', 'nearest_metrotube_distance'),
+    ('geoattributes.DISTANCE TO MOTORWAY JUNCTION',
+        'nearest_motorway_distance'),
+    ('geoattributes.DISTANCE TO OVERHEAD LINE', 'nearest_ohl_distance'),
+    ('geoattributes.DISTANCE TO PRIMARY SCHOOL',
+        'nearest_primary_school_distance'),
+    ('geoattributes.DISTANCE TO RAIL STATION', 'nearest_trainstop_distance'),
+    ('geoattributes.DISTANCE TO SECONDARY SCHOOL',
+        'nearest_secondary_school_distance'),
+    ('geoattributes.DISTANCE TO SUBSTATION', 'nearest_substation_distance'),
+])
+
+# The scoring columns held as booleans on a Location
+BOOLEAN_FEATURES = ('geoattributes.BROADBAND', 'greenbelt overlap')
+
+# The attribute holding the 'greenbelt overlap' as a proportion (0 to 1)
+# rather than a boolean
+GREENBELT_OVERLAP_RATIO = 'greenbelt_overlap_ratio'
+
+
 class SchoolRankingConfig(object):
     '''The attributes of the location ranking for building
     schools, that can be plugged into the more general z-values algorithm.
 
     i.e. the extraction of features from the location and query
     and the 'ideal' values (whether high is better or not)
+
+    With greenbelt_ratio, the 'greenbelt overlap' is the proportion of the
+    location overlapping a greenbelt, rather than whether it does.
     '''
-    def __init__(self, lower_site_req, upper_site_req, school_type):
+    def __init__(self, lower_site_req, upper_site_req, school_type,
+                 greenbelt_ratio=False):
         self.lower_site_req = lower_site_req
         self.upper_site_req = upper_site_req
         self.school_type = school_type
 
-        self.ideal_values = dict([
+        # the Location attribute holding each scoring column
+        self.location_features = OrderedDict(LOCATION_FEATURES)
+        self.boolean_features = set(BOOLEAN_FEATURES)
+        if greenbelt_ratio:
+            self.location_features['greenbelt overlap'] = \
+                GREENBELT_OVERLAP_RATIO
+            self.boolean_features.discard('greenbelt overlap')
+
+        # the scoring columns, in the order of the feature matrix
+        self.ideal_values = OrderedDict([
             ('area_suitable', 1),
             ('geoattributes.BROADBAND', 1),
             ('greenbelt overlap', 0),
@@ -65,8 +106,9 @@ class SchoolRankingConfig(object):
         ])
 
     def locations_to_dataframe(self, locations):
-        '''Converts location objects (as a list or ResultSet) to a DataFrame.
-        The fields kept are exactly the attributes needed for the scoring.
+        '''Converts locations (as a list of objects or a QuerySet) to a
+        DataFrame, indexed by id. The fields kept are exactly the attributes
+        needed for the scoring.
         '''
         # TODO
         # Check that distances are correctly either euclidean or network.
@@ -81,26 +123,52 @@ class SchoolRankingConfig(object):
         #   'geoattributes.DISTANCE TO OVERHEAD LINE',
         #   'geoattributes.DISTANCE TO SUBSTATION'
 
-        df = pd.DataFrame([
-            {
-                'estimated_floor_space': l.estimated_floor_space,
-                'geoattributes.BROADBAND': 1.0 if l.nearest_broadband_fast else 0.0,
-                'greenbelt overlap': l.greenbelt_overlap,
-                'geoattributes.DISTANCE TO BUS STOP': l.nearest_busstop_distance,
-                'geoattributes.DISTANCE TO METRO STATION': l.nearest_metrotube_distance,
-                'geoattributes.DISTANCE TO MOTORWAY JUNCTION': l.nearest_motorway_distance,
-                'geoattributes.DISTANCE TO OVERHEAD LINE': l.nearest_ohl_distance,
-                'geoattributes.DISTANCE TO PRIMARY SCHOOL': l.nearest_primary_school_distance,
-                'geoattributes.DISTANCE TO RAIL STATION': l.nearest_trainstop_distance,
-                'geoattributes.DISTANCE TO SECONDARY SCHOOL': l.nearest_secondary_school_distance,
-                'geoattributes.DISTANCE TO SUBSTATION': l.nearest_substation_distance,
-                }
-            for l in locations
-            ],
-            index=[l.id for l in locations])
-        df = df.apply(lambda x: pd.to_numeric(x, errors='ignore'))
-
-        return df
+        if hasattr(locations, 'values_list'):
+            # A QuerySet: fetch just the scoring columns, rather than
+            # building every Location (and decoding its geometry)
+            rows = list(locations.values_list(
+                'id', *self.location_features.values()))
+        else:
+            rows = [
+                [l.id] + [getattr(l, attr)
+                          for attr in self.location_features.values()]
+                for l in locations]
+
+        values = np.array(rows, dtype=np.float64).reshape(
+            len(rows), 1 + len(self.location_features))
+        # no broadband information counts as not fast
+        broadband = 1 + list(self.location_features).index(
+            'geoattributes.BROADBAND')
+        values[:, broadband] = np.nan_to_num(values[:, broadband])
+
+        return pd.DataFrame(
+            values[:, 1:], index=values[:, 0].astype(np.int64),
+            columns=list(self.location_features))
+
+    def features_sql(self):
+        '''Returns the SQL expressions, and their params, of the scoring
+        columns (in ideal_values order) over a row with the Location
+        attributes in location_features.
+        '''
+        expressions = []
+        params = []
+        for column in self.ideal_values:
+            if column == 'area_suitable':
+                expressions.append(
+                    'COALESCE(estimated_floor_space > %s AND '
+                    'estimated_floor_space < %s, false)::int::float8')
+                params.extend([self.lower_site_req, self.upper_site_req])
+            elif column == 'geoattributes.BROADBAND':
+                expressions.append(
+                    'COALESCE({0}::int, 0)::float8'.format(
+                        self.location_features[column]))
+            elif column in self.boolean_features:
+                expressions.append('{0}::int::float8'.format(
+                    self.location_features[column]))
+            else:
+                expressions.append(
+                    '{0}::float8'.format(self.location_features[column]))
+        return expressions, params
 
     def extract_features(self, df):
         '''Create further features, based on the location data and the query.
@@ -125,27 +193,137 @@ def score_results_dataframe(results_dataframe, ranking_config):
     '''
     df = results_dataframe
 
-    # filter to only the columns that we'll score against
-    scoring_columns = ranking_config.ideal_values.keys()
-    df2 = pd.concat([df[col] for col in scoring_columns], axis=1)
+    # filter to only the columns that we'll score against, as a matrix
+    scoring_columns = list(ranking_config.ideal_values.keys())
+    features = df[scoring_columns].values.astype(np.float64)
 
     # z-score scaling
     # (not really necessary because we scale it again, but useful for
     #  analysis)
     if False:
-        z_score_scaling(df2)
+        z_score_scaling(df[scoring_columns])
+
+    scaled, scores = score_matrix(features, ranking_config.ideal_values)
 
+    df3 = pd.DataFrame(scaled, index=df.index, columns=scoring_columns)
+    df3['score'] = scores
+    return df3
+
+
+def score_matrix(features, ideal_values):
+    '''Given a float matrix with a row per location and a column per scoring
+    column (in the order of ideal_values), return the features rescaled 0 to
+    1 with 1 always best, and the score of each row.
+    '''
     # Rescale minimum = 0 and maximum = 1 for each column
-    df3 = rescale_columns_0_to_1(df2)
+    scaled = rescale_0_to_1(features)
 
-    flip_columns_so_1_is_always_best(df3, ranking_config)
+    flip = np.array(
+        [ideal_value == 0 for ideal_value in ideal_values.values()],
+        dtype=bool)
+    scaled[:, flip] = 1.0 - scaled[:, flip]
 
     # Assume gaps in the data score 0
     # NaN -> 0
-    df3 = df3.fillna(0)
+    scaled[np.isnan(scaled)] = 0.0
 
-    calculate_score(df3)
-    return df3
+    return scaled, np.linalg.norm(scaled, axis=1)
+
+
+def rescale_0_to_1(features):
+    '''Rescale the values of each column of a float matrix so that they are
+    between 0 and 1, ignoring the gaps (NaN) in the data.
+    '''
+    if not features.shape[0]:
+        return features.copy()
+    # fmin/fmax ignore NaN, unless the whole column is NaN
+    minimum = np.fmin.reduce(features, axis=0)
+    value_range = np.fmax.reduce(features, axis=0) - minimum
+    value_range[value_range == 0] = 0.1
+    return (features - minimum) / value_range
+
+
+def rank_sql(ranking_config, results_sql, results_params, limit, offset=0,
+             after=None):
+    '''Returns the SQL, and its params, scoring the locations selected by
+    `results_sql` (with the Location attributes in the location_features of
+    the ranking config) like score_results_dataframe does. It returns the
+    `limit` best rows after `offset`, each with the id, the rescaled scoring
+    columns and the score.
+    Given the (score, id) of a row as `after`, only the rows ranked below it
+    are returned.
+    '''
+    expressions, params = ranking_config.features_sql()
+    columns = range(len(expressions))
+
+    # the equivalent of score_matrix, a column at a time
+    scaled = []
+    for i, ideal_value in zip(columns, ranking_config.ideal_values.values()):
+        expression = (
+            '(f.f{0} - b.min{0}) / COALESCE(NULLIF(b.range{0}, 0), 0.1)')
+        if ideal_value == 0:
+            expression = '1.0 - ' + expression
+        scaled.append(
+            'COALESCE({0}, 0) AS s{1}'.format(expression.format(i), i))
+
+    sql = (
+        'WITH features AS ('
+        'SELECT id, {features} FROM ({results}) AS results'
+        '), bounds AS ('
+        'SELECT {bounds} FROM features'
+        '), scaled AS ('
+        'SELECT f.id, {scaled} FROM features AS f CROSS JOIN bounds AS b'
+        ') '
+        'SELECT * FROM ('
+        'SELECT id, {columns}, sqrt({squares}) AS score FROM scaled'
+        ') AS ranked{where} '
+        'ORDER BY score DESC, id LIMIT %s OFFSET %s').format(
+            features=', '.join(
+                '{0} AS f{1}'.format(expression, i)
+                for i, expression in zip(columns, expressions)),
+            results=results_sql,
+            bounds=', '.join(
+                'min(f{0}) AS min{0}, '
+                'max(f{0}) - min(f{0}) AS range{0}'.format(i)
+                for i in columns),
+            scaled=', '.join(scaled),
+            columns=', '.join('s{0}'.format(i) for i in columns),
+            squares=' + '.join('s{0} * s{0}'.format(i) for i in columns),
+            where=(
+                ' WHERE score < %s OR (score = %s AND id > %s)'
+                if after else ''))
+
+    params = params + list(results_params)
+    if after:
+        score, location_id = after
+        params.extend([score, score, location_id])
+    return sql, params + [limit, offset]
+
+
+def rank_queryset(locations, ranking_config, limit, offset=0, after=None):
+    '''Scores the locations of a QuerySet in the database, and returns only
+    the `limit` best ones after `offset` (or ranked below `after`, see
+    rank_sql), as a dataframe indexed by id with the same columns as
+    score_results_dataframe, best first.
+    '''
+    from django.db import connections
+
+    results_sql, results_params = locations.values_list(
+        'id', *ranking_config.location_features.values()
+        ).query.sql_with_params()
+    sql, params = rank_sql(
+        ranking_config, results_sql, results_params, limit, offset, after)
+
+    with connections[locations.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    columns = list(ranking_config.ideal_values) + ['score']
+    values = np.array(rows, dtype=np.float64).reshape(
+        len(rows), 1 + len(columns))
+
+    return pd.DataFrame(
+        values[:, 1:], index=values[:, 0].astype(np.int64), columns=columns)
 
 
 def z_score_scaling(df):
@@ -169,9 +347,9 @@ def z_score_scaling(df):
 
 def rescale_columns_0_to_1(df):
     '''Rescale values in each column so that they are between 0 and 1.'''
-    return df.apply(
-        lambda x: (x.astype(float) - min(x)) / ((max(x) - min(x)) or 0.1),
-        axis=0)
+    return pd.DataFrame(
+        rescale_0_to_1(df.values.astype(np.float64)),
+        index=df.index, columns=df.columns)
 
 
 def flip_columns_so_1_is_always_best(df, ranking_config):
@@ -183,11 +361,10 @@ def flip_columns_so_1_is_always_best(df, ranking_config):
     columns_to_flip = [
         col for col, ideal_value in ranking_config.ideal_values.items()
         if ideal_value == 0]
-    for col in columns_to_flip:
-        df[col] = df[col].map(lambda x: 1.0 - x)
+    df[columns_to_flip] = 1.0 - df[columns_to_flip]
 
 def calculate_score(df):
     '''Given inputs as rows of a dataframe, that are scaled 0 to 1, this
     function appends a column 'score' for ranking. (Score: bigger=better)
     '''
-    df['score'] = np.linalg.norm(df, axis=1)
+    df['score'] = np.linalg.norm(df.values, axis=1)
@@ -0,0 +1,32 @@
+import json
+
+from rest_framework.renderers import JSONRenderer
+
+
+class LocationsJSONRenderer(JSONRenderer):
+    '''Renders the same bytes as JSONRenderer, for data made only of plain
+    Python types (e.g. from serializers.location_rows), by encoding it in a
+    single pass of the C encoder. Anything else (or an indented response)
+    is left to JSONRenderer.
+    '''
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or self.get_indent(
+                accepted_media_type, renderer_context or {}) is not None:
+            return super(LocationsJSONRenderer, self).render(
+                data, accepted_media_type, renderer_context)
+
+        try:
+            ret = json.dumps(
+                data, ensure_ascii=self.ensure_ascii,
+                allow_nan=not getattr(self, 'strict', False),
+                separators=(',', ':') if self.compact else (', ', ': '))
+        except TypeError:
+            return super(LocationsJSONRenderer, self).render(
+                data, accepted_media_type, renderer_context)
+
+        # escaped as JSONRenderer does, so that it's valid javascript too
+        if '\u2028' in ret or '\u2029' in ret:
+            ret = ret.replace('\u2028', '\\u2028').replace(
+                '\u2029', '\\u2029')
+        return ret.encode('utf-8')
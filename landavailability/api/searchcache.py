@@ -0,0 +1,80 @@
+'''Caching of the location searches.
+
+A search is keyed by its normalised query parameters (and the format it is
+rendered in), and versioned by the DatasetVersion, which is bumped whenever
+the Locations or the amenities change (once the change is committed), so
+entries are never stale: a change just moves the searches on to new
+versions. The same key and version make the
+ETag of the response.
+'''
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.http import urlencode
+
+from .postcodes import normalise_postcode
+
+DEFAULT_TIMEOUT = 60 * 60
+
+KEY_PREFIX = 'locations:'
+
+
+def search_cache():
+    '''Returns the cache of the searches, or None if they aren't cached.'''
+    alias = getattr(settings, 'LOCATION_SEARCH_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def search_key(query_params, format=None):
+    '''Returns the normalised query of a search, e.g. with the parameters
+    sorted and the postcode without spaces.
+    '''
+    params = []
+    for name, values in sorted(query_params.lists()):
+        values = [value.strip() for value in values]
+        if name == 'postcode':
+            values = [normalise_postcode(value) for value in values]
+        params.append((name, values))
+    if format:
+        params.append(('', [format]))
+    return urlencode(params, doseq=True)
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def search_etag(key, version):
+    '''Returns the (quoted) ETag of the response to a search.'''
+    return '"{0}"'.format(_digest('{0}:{1}'.format(version, key)))
+
+
+def etag_matches(if_none_match, etag):
+    '''Returns whether an If-None-Match header matches the ETag.'''
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+
+def get_search(key, version):
+    '''Returns the cached data of a search, or None.'''
+    cache = search_cache()
+    if cache is None:
+        return None
+    # the polygons can be longer than some backends allow in a key
+    return cache.get(KEY_PREFIX + _digest(key), version=version)
+
+
+def set_search(key, version, data):
+    cache = search_cache()
+    if cache is not None:
+        cache.set(KEY_PREFIX + _digest(key), data, getattr(
+            settings, 'LOCATION_SEARCH_CACHE_TIMEOUT', DEFAULT_TIMEOUT),
+            version=version)
@@ -1,17 +1,131 @@
 from .models import (
     BusStop, TrainStop, Address, CodePoint, Broadband, MetroTube, Greenbelt,
-    Motorway, Substation, OverheadLine, School, Location)
+    Motorway, Substation, OverheadLine, School, Location, DatasetVersion)
+from .geometry import MAX_PRECISION, display_geometry_sql, round_coordinates
+from .bulk import upsert
+from .nearest import enrich_locations
+from .postcodes import normalise_postcode, postcode_point
 from rest_framework import serializers
+from rest_framework_gis.fields import GeometryField
 from django.contrib.gis.geos import GEOSGeometry, Point, MultiPolygon
+from django.db import connections, models
+from django.db.models.signals import post_save
 import json
+from collections import OrderedDict
+
+
+def natural_key(model):
+    '''Returns the name of the unique field (other than the primary key) by
+    which the instances of a model are created or updated.
+    '''
+    return [
+        field.name for field in model._meta.fields
+        if field.unique and not field.primary_key][0]
+
+
+def upsert_records(serializer, records):
+    '''Creates or updates (by the natural key of the serializer's model) an
+    instance per record of validated data, as the serializer's build() does
+    for one, and returns them along with the lists of the (distinct)
+    instances created and updated, as told by the INSERT.
+    The existing instances are fetched with one query, and all of them are
+    written with a single INSERT ... ON CONFLICT DO UPDATE.
+
+    As save() would, post_save is sent for each instance (with bulk=True, as
+    the DatasetVersion is bumped once for all of them). A key appearing more
+    than once is built up record after record, into the same instance.
+    '''
+    model = serializer.Meta.model
+    key = natural_key(model)
+
+    instances = dict(
+        (getattr(instance, key), instance)
+        for instance in model.objects.filter(
+            **{key + '__in': [record[key] for record in records]}))
+
+    objs = []
+    for record in records:
+        obj = serializer.build(record, instances.get(record[key]))
+        instances[getattr(obj, key)] = obj
+        objs.append(obj)
+
+    written = [instances[value] for value in OrderedDict(
+        (getattr(obj, key), None) for obj in objs)]
+    serializer.before_write(written)
+    created = upsert(model, written, key)
+    created_ids = set(id(obj) for obj in created)
+    updated = [obj for obj in written if id(obj) not in created_ids]
+    DatasetVersion.bump()
+
+    for obj in written:
+        post_save.send(
+            sender=model, instance=obj, created=id(obj) in created_ids,
+            update_fields=None, raw=False, using=obj._state.db, bulk=True)
+    return objs, created, updated
+
+
+class UpsertListSerializer(serializers.ListSerializer):
+    '''Creates (or updates) the instances of many records with
+    upsert_records, batch_size records at a time.
+    '''
+    batch_size = 1000
 
+    def create(self, validated_data):
+        key = natural_key(self.child.Meta.model)
+        # the keys of the rows created and updated, counting a key repeated
+        # by the records once (as created if an earlier batch created it)
+        created_keys = set()
+        updated_keys = set()
+
+        objs = []
+        for start in range(0, len(validated_data), self.batch_size):
+            batch_objs, created, updated = upsert_records(
+                self.child, validated_data[start:start + self.batch_size])
+            objs.extend(batch_objs)
+            created_keys.update(getattr(obj, key) for obj in created)
+            updated_keys.update(getattr(obj, key) for obj in updated)
+
+        updated_keys -= created_keys
+        # the number of rows created, and updated
+        self.created = len(created_keys)
+        self.updated = len(updated_keys)
+        return objs
+
+
+class UpsertModelSerializer(serializers.ModelSerializer):
+    '''A ModelSerializer which creates an instance, or updates the one with
+    the same natural key, with build(). With many=True (and
+    Meta.list_serializer_class = UpsertListSerializer) the records are
+    written in bulk.
+    '''
+
+    def build(self, validated_data, instance):
+        '''Returns the instance, or a new one if it is None, with the
+        validated data, without saving it.
+        '''
+        if instance is None:
+            return self.Meta.model(**validated_data)
+
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        return instance
+
+    def before_write(self, instances):
+        '''Called with the built instances, before they are written.'''
+        pass
+
+    def create(self, validated_data):
+        objs, created, updated = upsert_records(self, [validated_data])
+        return objs[0]
 
-class BusStopSerializer(serializers.ModelSerializer):
+
+class BusStopSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = BusStop
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -22,12 +136,8 @@ class BusStopSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
-        amic_code = validated_data['amic_code']
-
-        try:
-            bus_stop = BusStop.objects.get(amic_code=amic_code)
-        except BusStop.DoesNotExist:
+    def build(self, validated_data, bus_stop):
+        if bus_stop is None:
             bus_stop = BusStop()
 
         bus_stop.amic_code = validated_data.get('amic_code')
@@ -40,16 +150,16 @@ class BusStopSerializer(serializers.ModelSerializer):
         bus_stop.road = validated_data.get('road')
         bus_stop.nptg_code = validated_data.get('nptg_code')
 
-        bus_stop.save()
         return bus_stop
 
 
-class TrainStopSerializer(serializers.ModelSerializer):
+class TrainStopSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = TrainStop
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -60,12 +170,8 @@ class TrainStopSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
-        atcode_code = validated_data['atcode_code']
-
-        try:
-            train_stop = TrainStop.objects.get(atcode_code=atcode_code)
-        except TrainStop.DoesNotExist:
+    def build(self, validated_data, train_stop):
+        if train_stop is None:
             train_stop = TrainStop()
 
         train_stop.atcode_code = validated_data.get('atcode_code')
@@ -80,16 +186,16 @@ class TrainStopSerializer(serializers.ModelSerializer):
         train_stop.nptg_code = validated_data.get('nptg_code')
         train_stop.local_reference = validated_data.get('local_reference')
 
-        train_stop.save()
         return train_stop
 
 
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = Address
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -100,12 +206,8 @@ class AddressSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
-        uprn = validated_data['uprn']
-
-        try:
-            address = Address.objects.get(uprn=uprn)
-        except Address.DoesNotExist:
+    def build(self, validated_data, address):
+        if address is None:
             address = Address()
             address.uprn = validated_data.get('uprn')
 
@@ -121,16 +223,16 @@ class AddressSerializer(serializers.ModelSerializer):
                 validated_data.get('point').geojson,
                 srid=validated_data.get('srid'))
 
-        address.save()
         return address
 
 
-class CodePointSerializer(serializers.ModelSerializer):
+class CodePointSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = CodePoint
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -141,12 +243,13 @@ class CodePointSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
-        postcode = validated_data['postcode'].strip().replace(' ', '').upper()
+    def validate_postcode(self, postcode):
+        return normalise_postcode(postcode)
+
+    def build(self, validated_data, codepoint):
+        postcode = validated_data['postcode']
 
-        try:
-            codepoint = CodePoint.objects.get(postcode=postcode)
-        except CodePoint.DoesNotExist:
+        if codepoint is None:
             codepoint = CodePoint()
             codepoint.postcode = postcode
 
@@ -162,14 +265,14 @@ class CodePointSerializer(serializers.ModelSerializer):
                 validated_data.get('point').geojson,
                 srid=validated_data.get('srid'))
 
-        codepoint.save()
         return codepoint
 
 
-class BroadbandSerializer(serializers.ModelSerializer):
+class BroadbandSerializer(UpsertModelSerializer):
 
     class Meta:
         model = Broadband
+        list_serializer_class = UpsertListSerializer
         exclude = ('point',)
 
         # We want to handle duplicated entries manually so we remove the
@@ -181,24 +284,19 @@ class BroadbandSerializer(serializers.ModelSerializer):
         }
 
     def validate(self, data):
-        postcode = data['postcode'].strip().replace(' ', '').upper()
+        postcode = normalise_postcode(data['postcode'])
 
-        try:
-            codepoint = CodePoint.objects.get(postcode=postcode)
-        except CodePoint.DoesNotExist:
+        if postcode_point(postcode) is None:
             raise serializers.ValidationError(
                 "Given postcode does not exist in CodePoint")
 
         data['postcode'] = postcode
         return data
 
-    def create(self, validated_data):
+    def build(self, validated_data, broadband):
         postcode = validated_data['postcode']
-        codepoint = CodePoint.objects.get(postcode=postcode)
 
-        try:
-            broadband = Broadband.objects.get(postcode=postcode)
-        except Broadband.DoesNotExist:
+        if broadband is None:
             broadband = Broadband()
             broadband.postcode = postcode
 
@@ -210,18 +308,18 @@ class BroadbandSerializer(serializers.ModelSerializer):
         broadband.min_upload_speed = validated_data.get('min_upload_speed')
         broadband.avg_upload_speed = validated_data.get('avg_upload_speed')
         broadband.max_upload_speed = validated_data.get('max_upload_speed')
-        broadband.point = codepoint.point
+        broadband.point = postcode_point(postcode)
 
-        broadband.save()
         return broadband
 
 
-class MetroTubeSerializer(serializers.ModelSerializer):
+class MetroTubeSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = MetroTube
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -235,12 +333,10 @@ class MetroTubeSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
+    def build(self, validated_data, metrotube):
         atco_code = validated_data['atco_code']
 
-        try:
-            metrotube = MetroTube.objects.get(atco_code=atco_code)
-        except MetroTube.DoesNotExist:
+        if metrotube is None:
             metrotube = MetroTube()
             metrotube.atco_code = atco_code
 
@@ -251,16 +347,16 @@ class MetroTubeSerializer(serializers.ModelSerializer):
                 validated_data.get('point').geojson,
                 srid=validated_data.get('srid'))
 
-        metrotube.save()
         return metrotube
 
 
-class GreenbeltSerializer(serializers.ModelSerializer):
+class GreenbeltSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = Greenbelt
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -271,12 +367,10 @@ class GreenbeltSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
+    def build(self, validated_data, greenbelt):
         code = validated_data['code']
 
-        try:
-            greenbelt = Greenbelt.objects.get(code=code)
-        except Greenbelt.DoesNotExist:
+        if greenbelt is None:
             greenbelt = Greenbelt()
             greenbelt.code = code
 
@@ -290,16 +384,16 @@ class GreenbeltSerializer(serializers.ModelSerializer):
         greenbelt.area = validated_data.get('area')
         greenbelt.perimeter = validated_data.get('perimeter')
 
-        greenbelt.save()
         return greenbelt
 
 
-class MotorwaySerializer(serializers.ModelSerializer):
+class MotorwaySerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = Motorway
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -310,12 +404,10 @@ class MotorwaySerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
+    def build(self, validated_data, motorway):
         identifier = validated_data['identifier']
 
-        try:
-            motorway = Motorway.objects.get(identifier=identifier)
-        except Motorway.DoesNotExist:
+        if motorway is None:
             motorway = Motorway()
             motorway.identifier = identifier
 
@@ -324,16 +416,16 @@ class MotorwaySerializer(serializers.ModelSerializer):
                 validated_data.get('point').geojson,
                 srid=validated_data.get('srid'))
 
-        motorway.save()
         return motorway
 
 
-class SubstationSerializer(serializers.ModelSerializer):
+class SubstationSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = Substation
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -344,12 +436,10 @@ class SubstationSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
+    def build(self, validated_data, substation):
         name = validated_data['name']
 
-        try:
-            substation = Substation.objects.get(name=name)
-        except Substation.DoesNotExist:
+        if substation is None:
             substation = Substation()
             substation.name = name
 
@@ -363,16 +453,16 @@ class SubstationSerializer(serializers.ModelSerializer):
                 validated_data.get('geom').geojson,
                 srid=validated_data.get('srid'))
 
-        substation.save()
         return substation
 
 
-class OverheadLineSerializer(serializers.ModelSerializer):
+class OverheadLineSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = OverheadLine
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -383,12 +473,10 @@ class OverheadLineSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
+    def build(self, validated_data, overheadline):
         gdo_gid = validated_data['gdo_gid']
 
-        try:
-            overheadline = OverheadLine.objects.get(gdo_gid=gdo_gid)
-        except OverheadLine.DoesNotExist:
+        if overheadline is None:
             overheadline = OverheadLine()
             overheadline.gdo_gid = gdo_gid
 
@@ -403,16 +491,16 @@ class OverheadLineSerializer(serializers.ModelSerializer):
                 validated_data.get('geom').geojson,
                 srid=validated_data.get('srid'))
 
-        overheadline.save()
         return overheadline
 
 
-class SchoolSerializer(serializers.ModelSerializer):
+class SchoolSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = School
+        list_serializer_class = UpsertListSerializer
         fields = '__all__'
 
         # We want to handle duplicated entries manually so we remove the
@@ -423,12 +511,10 @@ class SchoolSerializer(serializers.ModelSerializer):
             }
         }
 
-    def create(self, validated_data):
+    def build(self, validated_data, school):
         urn = validated_data['urn']
 
-        try:
-            school = School.objects.get(urn=urn)
-        except School.DoesNotExist:
+        if school is None:
             school = School()
             school.urn = urn
 
@@ -442,17 +528,18 @@ class SchoolSerializer(serializers.ModelSerializer):
             validated_data.get('point').geojson,
             srid=validated_data.get('srid'))
 
-        school.save()
         return school
 
 
-class LocationSerializer(serializers.ModelSerializer):
+class LocationSerializer(UpsertModelSerializer):
     # this extra field is used to specify the srid geo format
     srid = serializers.IntegerField(write_only=True)
-    site_size = serializers.SerializerMethodField()
+    site_size = serializers.FloatField(read_only=True)
+    greenbelt_overlap_ratio = serializers.FloatField(read_only=True)
 
     class Meta:
         model = Location
+        list_serializer_class = UpsertListSerializer
         fields = (
             'id', 'uprn', 'ba_ref', 'name', 'point', 'geom',
             'authority', 'owner', 'unique_asset_id', 'full_address',
@@ -463,7 +550,7 @@ class LocationSerializer(serializers.ModelSerializer):
             'nearest_ohl_distance', 'nearest_motorway_id',
             'nearest_motorway_distance', 'nearest_broadband_id',
             'nearest_broadband_distance', 'nearest_broadband_fast',
-            'greenbelt_overlap',
+            'greenbelt_overlap', 'greenbelt_overlap_ratio',
             'nearest_primary_school_id', 'nearest_primary_school_distance',
             'nearest_secondary_school_id',
             'nearest_secondary_school_distance', 'nearest_metrotube_id',
@@ -481,15 +568,42 @@ class LocationSerializer(serializers.ModelSerializer):
             },
         }
 
-    def get_site_size(self, obj):
-        return obj.get_geom_area()
+    # The geometry level and precision of the representation are taken from
+    # the context, as set up by api.geometry.geometry_options/with_geometry,
+    # along with the list of fields to return (all of them if None)
 
-    def create(self, validated_data):
+    def get_fields(self):
+        fields = super(LocationSerializer, self).get_fields()
+
+        geometry = self.context.get('geometry', 'full')
+        if geometry in ('simplified', 'centroid', 'none'):
+            fields['geom'] = GeometryField(
+                source='display_geom', read_only=True)
+
+        requested_fields = self.context.get('fields')
+        if requested_fields is not None:
+            for field_name in list(fields):
+                if field_name not in requested_fields:
+                    del fields[field_name]
+
+        return fields
+
+    def to_representation(self, instance):
+        data = super(LocationSerializer, self).to_representation(instance)
+
+        precision = self.context.get('precision')
+        if precision is not None:
+            for field_name in ('point', 'geom'):
+                if data.get(field_name):
+                    data[field_name]['coordinates'] = round_coordinates(
+                        data[field_name]['coordinates'], precision)
+
+        return data
+
+    def build(self, validated_data, location):
         uprn = validated_data['uprn']
 
-        try:
-            location = Location.objects.get(uprn=uprn)
-        except Location.DoesNotExist:
+        if location is None:
             location = Location()
             location.uprn = uprn
 
@@ -514,5 +628,129 @@ class LocationSerializer(serializers.ModelSerializer):
         location.full_address = validated_data.get('full_address')
         location.estimated_floor_space = validated_data.get('estimated_floor_space')
 
-        location.save()
         return location
+
+    def before_write(self, locations):
+        # the geometries may have changed, so the amenities are resolved
+        # again for existing locations too, all in one go
+        enrich_locations(locations)
+        for location in locations:
+            # as Location.save does
+            location.site_size = location.get_geom_area()
+
+
+def _geojson(precision):
+    def to_geojson(geometry):
+        # the same as rest_framework_gis' GeoJsonDict
+        coordinates = geometry.coords
+        if precision is not None:
+            coordinates = round_coordinates(coordinates, precision)
+        return {'type': geometry.geom_type, 'coordinates': coordinates}
+    return to_geojson
+
+
+# the to_representation of these fields, for values that aren't None
+_FAST_REPRESENTATIONS = {
+    serializers.IntegerField: int,
+    serializers.FloatField: float,
+    serializers.CharField: str,
+    serializers.ReadOnlyField: None,
+    serializers.BooleanField: None,
+    serializers.NullBooleanField: None,
+    }
+
+
+def location_rows(locations, context=None):
+    '''Returns the same data as LocationSerializer(locations, many=True,
+    context=context).data, as plain dicts keyed (in order) by location id,
+    but fetched with values_list rather than as Location objects and
+    without going through the serializer fields one location at a time.
+    '''
+    context = context or {}
+    fields = [
+        field for field in LocationSerializer(context=context).fields.values()
+        if not field.write_only]
+
+    representations = []
+    for field in fields:
+        if isinstance(field, GeometryField):
+            representations.append(_geojson(context.get('precision')))
+        elif type(field) in _FAST_REPRESENTATIONS:
+            representations.append(_FAST_REPRESENTATIONS[type(field)])
+        else:
+            representations.append(field.to_representation)
+    names = [field.field_name for field in fields]
+
+    sources = [field.source for field in fields]
+    if 'id' not in sources:
+        sources.append('id')
+    id_index = sources.index('id')
+
+    return OrderedDict(
+        (row[id_index], dict(zip(names, [
+            value if value is None or representation is None
+            else representation(value)
+            for value, representation in zip(row, representations)])))
+        for row in locations.values_list(*sources))
+
+
+def location_rows_json(locations, context=None, limit=None):
+    '''Returns the JSON text of the list of the locations (a queryset), with
+    the fields of LocationSerializer, and their ids, built by PostGIS rather
+    than by serializing Location objects. Only the first `limit` locations
+    are in the JSON.
+
+    The geometries come from ST_AsGeoJSON, so their coordinates can be
+    formatted a little differently, and the JSON has PostgreSQL's spacing.
+    '''
+    context = context or {}
+    qn = connections[locations.db].ops.quote_name
+    precision = context.get('precision')
+    if precision is None:
+        precision = MAX_PRECISION
+
+    members = []
+    params = []
+    for field in LocationSerializer(context=context).fields.values():
+        if field.write_only:
+            continue
+        if field.source == 'display_geom':
+            expression, expression_params = display_geometry_sql(
+                'l.geom', **context)
+            model_field = None
+        else:
+            model_field = Location._meta.get_field(field.source)
+            expression = 'l.{0}'.format(qn(model_field.column))
+            expression_params = []
+        if expression is None:
+            expression = 'NULL'
+        elif isinstance(field, GeometryField):
+            expression = 'ST_AsGeoJSON({0}, %s)::json'.format(expression)
+            expression_params.append(precision)
+        elif isinstance(model_field, models.DecimalField):
+            # as DecimalField serializes them, with COERCE_DECIMAL_TO_STRING
+            expression += '::text'
+        members.append('%s, ' + expression)
+        params.append(field.field_name)
+        params.extend(expression_params)
+
+    row_filter = ''
+    if limit is not None:
+        row_filter = 'FILTER (WHERE page.n <= %s)'
+        params.append(limit)
+
+    ids_sql, ids_params = locations.values_list(
+        'id', flat=True).query.sql_with_params()
+    sql = '''
+        SELECT COALESCE(json_agg(json_build_object({0}) ORDER BY page.n)
+                        {1}, '[]')::text,
+               array_agg(page.id ORDER BY page.n)
+        FROM unnest(ARRAY({2})) WITH ORDINALITY AS page(id, n)
+        JOIN {3} l ON l.id = page.id
+        '''.format(', '.join(members), row_filter, ids_sql,
+                   qn(Location._meta.db_table))
+
+    with connections[locations.db].cursor() as cursor:
+        cursor.execute(sql, params + list(ids_params))
+        json_text, ids = cursor.fetchone()
+    return json_text, ids or []
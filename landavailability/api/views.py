@@ -1,202 +1,209 @@
 from rest_framework import generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework import status
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.settings import api_settings
 from .models import (
     BusStop, TrainStop, Address, CodePoint, Broadband, MetroTube, Greenbelt,
-    Motorway, Substation, OverheadLine, School, Location)
+    Motorway, Substation, OverheadLine, School, Location, DatasetVersion)
 from .serializers import (
     BusStopSerializer, TrainStopSerializer, AddressSerializer,
     CodePointSerializer, BroadbandSerializer, MetroTubeSerializer,
     GreenbeltSerializer, MotorwaySerializer, SubstationSerializer,
-    OverheadLineSerializer, SchoolSerializer, LocationSerializer)
+    OverheadLineSerializer, SchoolSerializer, LocationSerializer,
+    location_rows, location_rows_json)
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.gis.db.models.functions import Distance
 from django.contrib.gis.measure import D
-from django.db.models.query import QuerySet
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from collections import OrderedDict
+import base64
 import json
+from .geometry import geometry_options, with_geometry
+from .nearest import deferred_refresh
+from .parsers import NDJSONParser
 from .permissions import IsAdminOrReadOnlyUser
+from .postcodes import postcode_point
+from .renderers import LocationsJSONRenderer
+from .searchcache import (
+    etag_matches, get_search, search_etag, search_key, set_search)
 
 log = __import__('logging').getLogger(__name__)
 
 
 MIN_PAGE_SIZE = 1
 MAX_PAGE_SIZE = 100
-
-class BusStopCreateView(APIView):
-    permission_classes = (IsAdminUser, )
+RENDER_MODES = ('python', 'postgis')
+GREENBELT_OVERLAP_MODES = ('boolean', 'ratio')
+
+class BulkCreateMixin(object):
+    '''POST creates (or updates) one object, or a list of them sent as a
+    JSON array or as NDJSON. A list is validated as a whole, and saved in a
+    single transaction only if all of it is valid, with the nearest
+    amenities of the Locations refreshed once for all of it.
+    '''
+    serializer_class = None
+    parser_classes = tuple(api_settings.DEFAULT_PARSER_CLASSES) + (
+        NDJSONParser, )
+
+    def after_create(self, obj):
+        '''Called with each object saved.'''
+        pass
 
     def post(self, request, format=None):
-        serializer = BusStopSerializer(data=request.data)
-
-        if serializer.is_valid():
-            bus_stop = serializer.save()
-            bus_stop.update_close_locations()
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(request.data, list):
+            return self.post_many(request.data)
 
-
-class TrainStopCreateView(APIView):
-    permission_classes = (IsAdminUser, )
-
-    def post(self, request, format=None):
-        serializer = TrainStopSerializer(data=request.data)
+        serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            train_stop = serializer.save()
-            train_stop.update_close_locations()
+            obj = serializer.save()
+            self.after_create(obj)
 
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-
-class AddressCreateView(APIView):
+    def post_many(self, records):
+        serializer = self.serializer_class(data=records, many=True)
+
+        if not serializer.is_valid():
+            errors = OrderedDict(
+                (i, record_errors)
+                for i, record_errors in enumerate(serializer.errors)
+                if record_errors)
+            log.info('%s of %s records are invalid', len(errors), len(records))
+            return Response({
+                'received': len(records),
+                'invalid': len(errors),
+                'errors': errors,
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic(), deferred_refresh():
+            for obj in serializer.save():
+                self.after_create(obj)
+
+        return Response({
+            'received': len(records),
+            'created': serializer.created,
+            'updated': serializer.updated,
+            }, status=status.HTTP_201_CREATED)
+
+
+class BusStopCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = BusStopSerializer
 
-    def post(self, request, format=None):
-        serializer = AddressSerializer(data=request.data)
-
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def after_create(self, bus_stop):
+        bus_stop.update_close_locations()
 
 
-class CodePointCreateView(APIView):
+class TrainStopCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = TrainStopSerializer
 
-    def post(self, request, format=None):
-        serializer = CodePointSerializer(data=request.data)
+    def after_create(self, train_stop):
+        train_stop.update_close_locations()
 
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-
-class BroadbandCreateView(APIView):
+class AddressCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
-
-    def post(self, request, format=None):
-        serializer = BroadbandSerializer(data=request.data)
-
-        if serializer.is_valid():
-            broadband = serializer.save()
-            broadband.update_close_locations()
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    serializer_class = AddressSerializer
 
 
-class MetroTubeCreateView(APIView):
+class CodePointCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = CodePointSerializer
 
-    def post(self, request, format=None):
-        serializer = MetroTubeSerializer(data=request.data)
-
-        if serializer.is_valid():
-            metrotube = serializer.save()
-            metrotube.update_close_locations()
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-
-class GreenbeltCreateView(APIView):
+class BroadbandCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = BroadbandSerializer
 
-    def post(self, request, format=None):
-        serializer = GreenbeltSerializer(data=request.data)
-
-        if serializer.is_valid():
-            serializer.save()
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def after_create(self, broadband):
+        broadband.update_close_locations()
 
 
-class MotorwayCreateView(APIView):
+class MetroTubeCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = MetroTubeSerializer
 
-    def post(self, request, format=None):
-        serializer = MotorwaySerializer(data=request.data)
-
-        if serializer.is_valid():
-            motorway = serializer.save()
-            motorway.update_close_locations()
+    def after_create(self, metrotube):
+        metrotube.update_close_locations()
 
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-
-class SubstationCreateView(APIView):
+class GreenbeltCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
-
-    def post(self, request, format=None):
-        serializer = SubstationSerializer(data=request.data)
-
-        if serializer.is_valid():
-            substation = serializer.save()
-            substation.update_close_locations()
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    serializer_class = GreenbeltSerializer
 
 
-class OverheadLineCreateView(APIView):
+class MotorwayCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = MotorwaySerializer
 
-    def post(self, request, format=None):
-        serializer = OverheadLineSerializer(data=request.data)
+    def after_create(self, motorway):
+        motorway.update_close_locations()
 
-        if serializer.is_valid():
-            overheadline = serializer.save()
-            overheadline.update_close_locations()
 
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+class SubstationCreateView(BulkCreateMixin, APIView):
+    permission_classes = (IsAdminUser, )
+    serializer_class = SubstationSerializer
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def after_create(self, substation):
+        substation.update_close_locations()
 
 
-class SchoolCreateView(APIView):
+class OverheadLineCreateView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminUser, )
+    serializer_class = OverheadLineSerializer
 
-    def post(self, request, format=None):
-        serializer = SchoolSerializer(data=request.data)
+    def after_create(self, overheadline):
+        overheadline.update_close_locations()
 
-        if serializer.is_valid():
-            school = serializer.save()
-            school.update_close_locations()
 
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+class SchoolCreateView(BulkCreateMixin, APIView):
+    permission_classes = (IsAdminUser, )
+    serializer_class = SchoolSerializer
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def after_create(self, school):
+        school.update_close_locations()
 
 
-class LocationView(APIView):
+class LocationView(BulkCreateMixin, APIView):
     permission_classes = (IsAdminOrReadOnlyUser, )
+    renderer_classes = (LocationsJSONRenderer, BrowsableAPIRenderer)
+    serializer_class = LocationSerializer
 
-    def post(self, request, format=None):
-        serializer = LocationSerializer(data=request.data)
-
-        if serializer.is_valid():
-            school = serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+    def get(self, request, *args, **kwargs):
+        # the same search gives the same response until the data changes
+        version = DatasetVersion.current()
+        key = search_key(
+            request.query_params, request.accepted_renderer.format)
+        etag = search_etag(key, version)
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            return response
+
+        data = get_search(key, version)
+        if data is not None:
+            response = Response(data, status=status.HTTP_200_OK)
+        else:
+            response = self.search(request)
+            # the streamed (render=postgis) responses aren't cached
+            if response.status_code == status.HTTP_200_OK and isinstance(
+                    response, Response):
+                set_search(key, version, response.data)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
 
-    def get(self, request, *args, **kwargs):
+    def search(self, request):
         postcode = request.query_params.get('postcode')
         range_distance = request.query_params.get('range_distance')
         polygon = request.query_params.get('polygon')
@@ -205,6 +212,12 @@ class LocationView(APIView):
         num_pupils_post16 = request.query_params.get('num_pupils_post16', 0)
         page = request.query_params.get('page', 1)
         page_size = request.query_params.get('page_size', 20)
+        cursor = request.query_params.get('cursor')
+        # the JSON of unranked locations can be built by PostGIS instead
+        render = request.query_params.get('render', 'python')
+        # the ranking can score the proportion of greenbelt overlap instead
+        greenbelt_overlap = request.query_params.get(
+            'greenbelt_overlap', 'boolean')
 
         try:
             num_pupils = int(num_pupils)
@@ -249,6 +262,56 @@ class LocationView(APIView):
                      page)
             return Response('page must be 1 or above',
                             status=status.HTTP_400_BAD_REQUEST)
+        try:
+            representation = geometry_options(request.query_params)
+        except ValueError as e:
+            log.info('Invalid geometry parameters: %s', e)
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        if render not in RENDER_MODES:
+            log.info('render should be one of %s not %r',
+                     RENDER_MODES, render)
+            return Response('render parameter must be one of: {}'.format(
+                ', '.join(RENDER_MODES)),
+                status=status.HTTP_400_BAD_REQUEST)
+        if greenbelt_overlap not in GREENBELT_OVERLAP_MODES:
+            log.info('greenbelt_overlap should be one of %s not %r',
+                     GREENBELT_OVERLAP_MODES, greenbelt_overlap)
+            return Response(
+                'greenbelt_overlap parameter must be one of: {}'.format(
+                    ', '.join(GREENBELT_OVERLAP_MODES)),
+                status=status.HTTP_400_BAD_REQUEST)
+        if render == 'postgis' and build:
+            log.info('render=postgis is not available with build')
+            return Response('render=postgis is only available without build',
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # filter on the site size (m^2)
+        site_size_filters = {}
+        for param, lookup in (('min_site_size', 'site_size__gte'),
+                              ('max_site_size', 'site_size__lte')):
+            value = request.query_params.get(param)
+            if value is None:
+                continue
+            try:
+                site_size_filters[lookup] = float(value)
+            except ValueError:
+                log.info('%s parameter must be a number not %r',
+                         param, value)
+                return Response('{} parameter must be a number'.format(param),
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        # cursor paging: an empty cursor asks for the first page, and each
+        # page returns the cursor of the next one
+        after = None
+        if cursor:
+            try:
+                after = decode_cursor(cursor)
+                if len(after) != (2 if build else 1):
+                    raise ValueError('Wrong number of values')
+            except ValueError:
+                log.info('cursor parameter %r is invalid', cursor)
+                return Response('cursor parameter is invalid',
+                                status=status.HTTP_400_BAD_REQUEST)
 
         # work out which locations are requested
         if polygon:
@@ -265,21 +328,17 @@ class LocationView(APIView):
             locations = Location.objects.filter(geom__intersects=geometry).\
                 order_by('id')
         elif postcode and range_distance:
-            # Normalise postcode first
-            postcode = postcode.replace(' ', '').upper()
-
-            try:
-                codepoint = CodePoint.objects.get(postcode=postcode)
-            except CodePoint.DoesNotExist:
+            point = postcode_point(postcode)
+            if point is None:
                 log.info('postcode %s not found in CodePoint', postcode)
                 return Response(
                     'The given postcode is not available in CodePoint',
                     status=status.HTTP_400_BAD_REQUEST)
 
             locations = Location.objects.filter(
-                geom__dwithin=(codepoint.point, D(m=range_distance))).\
+                geom__dwithin=(point, D(m=range_distance))).\
                 order_by('id').\
-                annotate(distance=Distance('geom', codepoint.point))
+                annotate(distance=Distance('geom', point))
         else:
             log.info('Params missing postcode and range_distance OR '
                      'polygon')
@@ -288,15 +347,44 @@ class LocationView(APIView):
                 'polygon',
                 status=status.HTTP_400_BAD_REQUEST)
 
+        if site_size_filters:
+            locations = locations.filter(**site_size_filters)
+
         # serialize them
         from .ranking import (school_site_size_range,
-                              score_results_dataframe,
+                              rank_queryset,
                               SchoolRankingConfig,
                               )
         return_data = {}
 
+        # the ranking columns can be asked for too
+        ranking_fields = []
+        if build:
+            ranking_fields = list(SchoolRankingConfig(
+                lower_site_req=0, upper_site_req=0,
+                school_type=build).ideal_values) + ['score']
+        try:
+            representation['fields'] = sparse_fields(
+                request.query_params, ranking_fields)
+        except ValueError as e:
+            log.info('Invalid fields parameter: %s', e)
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        # paging
+        offset = page_size * (page - 1)
+        if cursor is not None:
+            # fetch one more, to know if there is a next page
+            offset = 0
+            limit = page_size + 1
+        elif offset > locations.count():
+            log.info('Page %s is out of range', offset)
+            return Response('"page" is out of range',
+                            status=status.HTTP_404_NOT_FOUND)
+        else:
+            limit = page_size
+
         # score & order them
-        if build and locations:
+        if build:
             if build not in ('secondary_school', 'primary_school'):
                 log.info('build should be "secondary_school" or '
                          '"primary_school" not %r', build)
@@ -310,51 +398,159 @@ class LocationView(APIView):
                 })
             ranking_config = SchoolRankingConfig(
                 lower_site_req=lower_site_req, upper_site_req=upper_site_req,
-                school_type=build)
-            locations = ranking_config.locations_to_dataframe(locations)
-            ranking_config.extract_features(locations)
-            scored_locations = score_results_dataframe(locations,
-                                                       ranking_config)
-
-        # paging
-        offset = page_size * (page - 1)
-        if offset > len(locations):
-            log.info('Page %s is out of range', offset)
-            return Response('"page" is out of range',
-                            status=status.HTTP_404_NOT_FOUND)
-        locations_to_show = locations[offset:offset + page_size]
+                school_type=build,
+                greenbelt_ratio=greenbelt_overlap == 'ratio')
+            # the database scores them all, but only returns the page
+            scored_locations = rank_queryset(
+                locations, ranking_config, limit=limit, offset=offset,
+                after=after)
+            if cursor is not None:
+                return_data['next_cursor'] = None
+                if len(scored_locations) > page_size:
+                    scored_locations = scored_locations.iloc[:page_size]
+                    return_data['next_cursor'] = encode_cursor([
+                        float(scored_locations['score'].iloc[-1]),
+                        int(scored_locations.index[-1])])
 
         # convert to Location objects
         # also consider just returning JSON with the score and scoring details
-        if isinstance(locations, QuerySet):
-            location_ids = [l.id for l in locations_to_show]
-        else:
-            # locations is a dataframe, because they have been ranked
-            location_ids = locations_to_show.index
-        location_objs = Location.objects.filter(id__in=location_ids).\
-            order_by('id')
-        # sort by score
         if build:
-            location_objs_and_ranking_info = [
-                merge_dicts(
-                    LocationSerializer(location_obj).data,
-                    scored_locations.iloc[[i]].to_dict(orient='records')[0])
-                for i, location_obj in enumerate(location_objs)
-                ]
-            location_objs_and_ranking_info.sort(
-                key=lambda x: -x['score']
-                )
+            location_objs_and_ranking_info = ranked_locations_data(
+                representation_queryset(
+                    Location.objects.filter(
+                        id__in=list(scored_locations.index)),
+                    representation),
+                scored_locations, context=representation)
             log.debug('Scores: %s',
-                      [(l['name'], l['score'])
-                       for l in location_objs_and_ranking_info]
+                      list(zip(scored_locations.index,
+                               scored_locations['score']))
                       )
             return_data['locations'] = location_objs_and_ranking_info
         else:
-            serializer = LocationSerializer(location_objs, many=True)
-            return_data['locations'] = serializer.data
+            if after:
+                locations = locations.filter(id__gt=after[0])
+            if render == 'postgis':
+                locations_json, location_ids = location_rows_json(
+                    locations[offset:offset + limit],
+                    context=representation, limit=page_size)
+                if cursor is not None:
+                    return_data['next_cursor'] = None
+                    if len(location_ids) > page_size:
+                        return_data['next_cursor'] = encode_cursor(
+                            [location_ids[page_size - 1]])
+                return json_text_response(
+                    return_data, 'locations', locations_json)
+            locations_data = location_rows(
+                representation_queryset(locations, representation)[
+                    offset:offset + limit],
+                context=representation)
+            location_ids = list(locations_data)
+            if cursor is not None:
+                return_data['next_cursor'] = None
+                if len(location_ids) > page_size:
+                    location_ids = location_ids[:page_size]
+                    return_data['next_cursor'] = encode_cursor(
+                        [location_ids[-1]])
+            return_data['locations'] = [
+                locations_data[location_id] for location_id in location_ids]
 
         return Response(return_data, status=status.HTTP_200_OK)
 
+def json_text_response(data, key, json_text):
+    '''Returns a streamed JSON response of data, with the (already JSON)
+    json_text as its `key`, which is passed on without being parsed.
+    '''
+    head = json.dumps(data, separators=(',', ':'))[:-1]
+    if data:
+        head += ','
+    head += json.dumps(key) + ':'
+    return StreamingHttpResponse(
+        iter((head, json_text, '}')), content_type='application/json',
+        status=status.HTTP_200_OK)
+
+
+def encode_cursor(values):
+    '''Returns an opaque cursor holding the given (JSON) values.'''
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''Returns the list of numbers held by a cursor from encode_cursor.
+    Raises ValueError if the cursor is invalid.
+    '''
+    values = json.loads(
+        base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    if not isinstance(values, list) or not all(
+            isinstance(value, (int, float)) for value in values):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def ranked_locations_data(locations, scored_locations, context=None):
+    '''Returns the serialized locations (a queryset), each merged with its
+    ranking info, in the order of scored_locations (a dataframe indexed by
+    location id, best first). Locations missing from `locations` are left
+    out.
+    '''
+    locations_data = location_rows(locations, context=context)
+    scored_locations = scored_locations[
+        scored_locations.index.isin(list(locations_data))]
+
+    fields = (context or {}).get('fields')
+    columns = [
+        column for column in scored_locations.columns
+        if fields is None or column in fields]
+    if columns:
+        ranking_infos = scored_locations[columns].to_dict(orient='records')
+    else:
+        ranking_infos = [{} for location_id in scored_locations.index]
+
+    return [
+        merge_dicts(locations_data[location_id], ranking_info)
+        for location_id, ranking_info in zip(
+            scored_locations.index, ranking_infos)
+        ]
+
+
+def sparse_fields(query_params, extra_fields=()):
+    '''Returns the LocationSerializer fields asked for with fields= (as a
+    comma separated list), or None for all of them. `extra_fields` can be
+    asked for too. Raises ValueError if any field is unknown.
+    '''
+    fields = query_params.get('fields')
+    if not fields:
+        return None
+
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    readable_fields = [
+        name for name, field in LocationSerializer().fields.items()
+        if not field.write_only]
+    unknown_fields = [
+        field for field in fields
+        if field not in readable_fields and field not in extra_fields]
+    if unknown_fields:
+        raise ValueError('Unknown fields: {}'.format(
+            ', '.join(unknown_fields)))
+    return fields
+
+
+def representation_queryset(locations, representation):
+    '''Returns the Locations queryset, fetching only the columns needed for
+    the representation (see geometry_options and sparse_fields).
+    '''
+    fields = representation.get('fields')
+    if fields is not None:
+        model_fields = []
+        for field in fields:
+            try:
+                model_fields.append(Location._meta.get_field(field).name)
+            except FieldDoesNotExist:
+                pass
+        locations = locations.only('id', *model_fields)
+    return with_geometry(locations, **representation)
+
+
 def merge_dicts(*dict_args):
     """
     Given any number of dicts, shallow copy and merge into a new dict,
@@ -372,3 +568,23 @@ class LocationDetailsView(generics.RetrieveAPIView):
     serializer_class = LocationSerializer
     lookup_field = 'uprn'
     lookup_url_kwarg = 'uprn'
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.representation = geometry_options(request.query_params)
+            self.representation['fields'] = sparse_fields(
+                request.query_params)
+        except ValueError as e:
+            log.info('Invalid parameters: %s', e)
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        return super(LocationDetailsView, self).get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return representation_queryset(
+            Location.objects.all(), self.representation)
+
+    def get_serializer_context(self):
+        context = super(LocationDetailsView, self).get_serializer_context()
+        context.update(self.representation)
+        return context
@@ -142,6 +142,16 @@ STATICFILES_DIRS = (
     os.path.join(PROJECT_ROOT, 'static'),
 )
 
+# Postcode lookups (see api/postcodes.py): the number of postcodes kept by
+# each process, and the alias of a cache shared between them, if any
+POSTCODE_CACHE_SIZE = 10000
+POSTCODE_CACHE = os.environ.get('LANDAVAILABILITY_POSTCODE_CACHE')
+
+# The alias of the cache of the location searches (see api/searchcache.py),
+# if they are cached, and for how long (seconds)
+LOCATION_SEARCH_CACHE = os.environ.get('LANDAVAILABILITY_SEARCH_CACHE')
+LOCATION_SEARCH_CACHE_TIMEOUT = 60 * 60
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.TokenAuthentication',
@@ -0,0 +1,31 @@
+from unittest import TestCase
+import pytest
+from django.contrib.gis.geos import LineString
+from api.bulk import upsert
+from api.models import OverheadLine
+
+
+class TestUpsert(TestCase):
+    def overhead_line(self, gdo_gid, status):
+        return OverheadLine(
+            gdo_gid=gdo_gid, status=status,
+            geom=LineString((-2.35, 53.38), (-2.34, 53.39), srid=4326))
+
+    @pytest.mark.django_db
+    def test_upsert_integer_key_values(self):
+        # e.g. as pyshp reads the numeric fields of a shapefile
+        created = upsert(OverheadLine, [
+            self.overhead_line(1001, 'Live'),
+            self.overhead_line(1002, 'Live')], 'gdo_gid')
+        self.assertEqual(len(created), 2)
+
+        lines = [
+            self.overhead_line(1002, 'Removed'),
+            self.overhead_line(1003, 'Live')]
+        created = upsert(OverheadLine, lines, 'gdo_gid')
+
+        self.assertEqual(created, [lines[1]])
+        self.assertTrue(all(line.pk for line in lines))
+        self.assertEqual(OverheadLine.objects.count(), 3)
+        self.assertEqual(
+            OverheadLine.objects.get(gdo_gid='1002').status, 'Removed')
@@ -1,11 +1,15 @@
 from unittest import TestCase
 import pytest
 import json
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.contrib.gis.geos import Point
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
 from api.models import (
     BusStop, Location, TrainStop, Substation, OverheadLine, Motorway,
-    Broadband, Greenbelt, School, MetroTube)
+    Broadband, Greenbelt, School, MetroTube, DatasetVersion)
+from api.nearest import (
+    deferred_refresh, enrich_locations, find_nearest, refresh_nearest)
 
 
 class TestBusStopModel(TestCase):
@@ -1319,6 +1323,8 @@ class TestLocationModel(TestCase):
         # different machines.
         self.assertEqual(round(saved_location.get_geom_area(), -3),
                          round(4532170, -3))
+        self.assertEqual(round(saved_location.site_size, -3),
+                         round(4532170, -3))
 
     @pytest.mark.django_db
     def test_metrotube_pre_delete_signal(self):
@@ -2068,3 +2074,307 @@ class TestLocationSiteRequirements(TestCase):
             pupils=100, school_type='secondary', post16=32)
         self.assertEqual(area_requirements['lower_area_req'], 1949.78)
         self.assertEqual(area_requirements['upper_area_req'], 3078.60)
+
+
+class TestRefreshNearest(TestCase):
+    def create_location(self):
+        location = Location()
+        location.name = 'Test Location'
+        geometry = """
+            {"coordinates": [
+                [
+                    [
+                        [-2.373605477415186, 53.40969504659278],
+                        [-2.3737618172100063, 53.409339507361864],
+                        [-2.372348437061216, 53.40941673318565],
+                        [-2.3730816588728425, 53.409842195613976],
+                        [-2.373605477415186, 53.40969504659278]
+                    ]
+                ]
+            ],
+            "type": "MultiPolygon"}
+        """
+        location.geom = GEOSGeometry(geometry, srid=4326)
+        location.point = location.geom.centroid
+        location.save()
+        return location
+
+    @pytest.mark.django_db
+    def test_refresh_nearest_all_locations(self):
+        self.create_location()
+
+        far_busstop = BusStop(
+            amic_code='FAR', name='Far BusStop',
+            point=Point(-2.3680, 53.4110))
+        far_busstop.save()
+        near_busstop = BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100))
+        near_busstop.save()
+
+        updated = refresh_nearest('busstop')
+
+        self.assertEqual(updated, 1)
+        updated_location = Location.objects.first()
+        self.assertEqual(updated_location.nearest_busstop.name, 'Near BusStop')
+        self.assertTrue(updated_location.nearest_busstop_distance < 100)
+
+    @pytest.mark.django_db
+    def test_refresh_nearest_changed_amenities(self):
+        self.create_location()
+
+        far_busstop = BusStop(
+            amic_code='FAR', name='Far BusStop',
+            point=Point(-2.3680, 53.4110))
+        far_busstop.save()
+        refresh_nearest('busstop', amenity_ids=[far_busstop.id])
+
+        updated_location = Location.objects.first()
+        self.assertEqual(updated_location.nearest_busstop.name, 'Far BusStop')
+
+        near_busstop = BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100))
+        near_busstop.save()
+        near_busstop.update_close_locations()
+
+        updated_location = Location.objects.first()
+        self.assertEqual(updated_location.nearest_busstop.name, 'Near BusStop')
+
+    @pytest.mark.django_db
+    def test_refresh_nearest_amenity_moved_out_of_range(self):
+        self.create_location()
+
+        busstop = BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100))
+        busstop.save()
+        refresh_nearest('busstop', amenity_ids=[busstop.id])
+        self.assertEqual(
+            Location.objects.first().nearest_busstop.name, 'Near BusStop')
+
+        BusStop.objects.filter(id=busstop.id).update(
+            point=Point(-1.0, 52.0))
+        updated = refresh_nearest('busstop', amenity_ids=[busstop.id])
+
+        self.assertEqual(updated, 1)
+        updated_location = Location.objects.first()
+        self.assertIsNone(updated_location.nearest_busstop)
+        self.assertEqual(updated_location.nearest_busstop_distance, 0)
+
+    @pytest.mark.django_db
+    def test_delete_replaces_nearest(self):
+        BusStop(
+            amic_code='FAR', name='Far BusStop',
+            point=Point(-2.3680, 53.4110)).save()
+        near_busstop = BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100))
+        near_busstop.save()
+
+        self.create_location()
+        self.assertEqual(
+            Location.objects.first().nearest_busstop.name, 'Near BusStop')
+
+        near_busstop.delete()
+
+        updated_location = Location.objects.first()
+        self.assertEqual(updated_location.nearest_busstop.name, 'Far BusStop')
+        self.assertTrue(updated_location.nearest_busstop_distance > 100)
+
+        BusStop.objects.all().delete()
+
+        updated_location = Location.objects.first()
+        self.assertIsNone(updated_location.nearest_busstop)
+        self.assertEqual(updated_location.nearest_busstop_distance, 0)
+
+    @pytest.mark.django_db
+    def test_find_nearest(self):
+        location = self.create_location()
+
+        BusStop(
+            amic_code='FAR', name='Far BusStop',
+            point=Point(-2.3680, 53.4110)).save()
+        BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100)).save()
+
+        nearest = find_nearest('busstop', location.geom)
+        self.assertEqual(nearest.name, 'Near BusStop')
+        self.assertTrue(nearest.distance < 100)
+
+        self.assertIsNone(find_nearest('busstop', location.geom, distance=1))
+
+    @pytest.mark.django_db
+    def test_update_nearest_on_new_location(self):
+        BusStop(
+            amic_code='FAR', name='Far BusStop',
+            point=Point(-2.3680, 53.4110)).save()
+        BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100)).save()
+
+        self.create_location()
+
+        saved_location = Location.objects.first()
+        self.assertEqual(saved_location.nearest_busstop.name, 'Near BusStop')
+        self.assertIsNone(saved_location.nearest_trainstop)
+
+    @pytest.mark.django_db
+    def test_enrich_locations_single_query(self):
+        BusStop(
+            amic_code='NEAR', name='Near BusStop',
+            point=Point(-2.3732, 53.4100)).save()
+        School(
+            urn='100001', school_name='Test Primary', school_type='PRIMARY',
+            point=Point(-2.3700, 53.4100)).save()
+
+        location = self.create_location()
+        other_location = Location(name='Other Location', geom=location.geom)
+
+        with CaptureQueriesContext(connection) as queries:
+            enrich_locations([location, other_location])
+
+        self.assertEqual(len(queries), 1)
+        for enriched in (location, other_location):
+            self.assertEqual(enriched.nearest_busstop.name, 'Near BusStop')
+            self.assertEqual(
+                enriched.nearest_primary_school.school_name, 'Test Primary')
+            self.assertIsNone(enriched.nearest_secondary_school)
+            self.assertFalse(enriched.greenbelt_overlap)
+
+    @pytest.mark.django_db
+    def test_deferred_refresh(self):
+        self.create_location()
+
+        with deferred_refresh():
+            far_busstop = BusStop(
+                amic_code='FAR', name='Far BusStop',
+                point=Point(-2.3680, 53.4110))
+            far_busstop.save()
+            far_busstop.update_close_locations()
+            near_busstop = BusStop(
+                amic_code='NEAR', name='Near BusStop',
+                point=Point(-2.3732, 53.4100))
+            near_busstop.save()
+            near_busstop.update_close_locations()
+
+            # nothing is refreshed until the end of the block
+            self.assertIsNone(Location.objects.first().nearest_busstop)
+
+        updated_location = Location.objects.first()
+        self.assertEqual(updated_location.nearest_busstop.name, 'Near BusStop')
+
+    @pytest.mark.django_db
+    def test_deferred_refresh_failed_block(self):
+        self.create_location()
+
+        with self.assertRaises(ValueError):
+            with deferred_refresh():
+                BusStop(
+                    amic_code='NEAR', name='Near BusStop',
+                    point=Point(-2.3732, 53.4100)).save()
+                BusStop.objects.get().update_close_locations()
+                raise ValueError('Bad record')
+
+        # the changes recorded by the failed block are dropped
+        self.assertIsNone(Location.objects.first().nearest_busstop)
+        with deferred_refresh():
+            pass
+        self.assertIsNone(Location.objects.first().nearest_busstop)
+
+    @pytest.mark.django_db
+    def test_deferred_greenbelt_overlap_refresh(self):
+        location = self.create_location()
+        self.assertFalse(Location.objects.first().greenbelt_overlap)
+
+        with deferred_refresh():
+            greenbelt = Greenbelt(
+                code='GB1',
+                geom=MultiPolygon(location.geom.envelope, srid=4326))
+            greenbelt.save()
+
+            # nothing is refreshed until the end of the block
+            self.assertFalse(Location.objects.first().greenbelt_overlap)
+
+        self.assertTrue(Location.objects.first().greenbelt_overlap)
+
+        greenbelt.delete()
+        self.assertFalse(Location.objects.first().greenbelt_overlap)
+
+    @pytest.mark.django_db
+    def test_greenbelt_overlap_ratio(self):
+        location = self.create_location()
+        self.assertEqual(Location.objects.first().greenbelt_overlap_ratio, 0)
+
+        # a greenbelt over the western half of the location
+        xmin, ymin, xmax, ymax = location.geom.extent
+        half = Polygon.from_bbox(
+            (xmin - 0.01, ymin - 0.01, (xmin + xmax) / 2, ymax + 0.01))
+        half.srid = 4326
+        Greenbelt(code='GB1', geom=MultiPolygon(half, srid=4326)).save()
+
+        overlap = location.geom.intersection(half)
+        expected_ratio = (
+            overlap.transform(27700, clone=True).area /
+            location.geom.transform(27700, clone=True).area)
+        updated_location = Location.objects.first()
+        self.assertTrue(updated_location.greenbelt_overlap)
+        self.assertAlmostEqual(
+            updated_location.greenbelt_overlap_ratio, expected_ratio, places=2)
+        self.assertTrue(0 < expected_ratio < 1)
+
+        # the same greenbelt twice doesn't count twice
+        Greenbelt(code='GB2', geom=MultiPolygon(half, srid=4326)).save()
+        self.assertAlmostEqual(
+            Location.objects.first().greenbelt_overlap_ratio, expected_ratio,
+            places=2)
+
+        Greenbelt.objects.all().delete()
+        self.assertEqual(Location.objects.first().greenbelt_overlap_ratio, 0)
+
+    @pytest.mark.django_db
+    def test_refresh_nearest_unknown_amenity(self):
+        with self.assertRaises(ValueError):
+            refresh_nearest('tramstop')
+
+
+class TestDatasetVersion(TestCase):
+    @pytest.mark.django_db(transaction=True)
+    def test_bumped_once_on_commit(self):
+        version = DatasetVersion.current()
+
+        with transaction.atomic():
+            BusStop(
+                amic_code='NEAR', name='Near BusStop',
+                point=Point(-2.3732, 53.4100)).save()
+            DatasetVersion.bump()
+            self.assertEqual(DatasetVersion.current(), version)
+
+        self.assertEqual(DatasetVersion.current(), version + 1)
+
+    @pytest.mark.django_db(transaction=True)
+    def test_not_bumped_on_rollback(self):
+        version = DatasetVersion.current()
+
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                DatasetVersion.bump()
+                raise ValueError('Rolled back')
+
+        self.assertEqual(DatasetVersion.current(), version)
+
+    @pytest.mark.django_db(transaction=True)
+    def test_bumped_after_rollback(self):
+        version = DatasetVersion.current()
+
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                DatasetVersion.bump()
+                raise ValueError('Rolled back')
+
+        with transaction.atomic():
+            DatasetVersion.bump()
+            DatasetVersion.bump()
+
+        self.assertEqual(DatasetVersion.current(), version + 1)
@@ -0,0 +1,80 @@
+from unittest import TestCase
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.gis.geos import Point
+from api.models import CodePoint
+from api.postcodes import (
+    PostcodeTable, postcode_point, preloaded_postcodes)
+
+
+class TestPostcodes(TestCase):
+    def create_codepoint(self, postcode, x, y):
+        codepoint = CodePoint()
+        codepoint.postcode = postcode
+        codepoint.quality = 10
+        codepoint.point = Point(x, y, srid=4326)
+        codepoint.save()
+        return codepoint
+
+    @pytest.mark.django_db
+    def test_postcode_point_is_cached(self):
+        self.create_codepoint('ME58TL', -1.8335, 55.4168)
+
+        with CaptureQueriesContext(connection) as queries:
+            point = postcode_point('me5 8tl')
+            self.assertEqual(postcode_point('ME58TL'), point)
+            self.assertIsNone(postcode_point('XX11YY'))
+            self.assertIsNone(postcode_point('XX11YY'))
+
+        # the postcode not found is looked up again
+        self.assertEqual(len(queries), 3)
+        self.assertAlmostEqual(point.x, -1.8335)
+        self.assertAlmostEqual(point.y, 55.4168)
+        self.assertEqual(point.srid, 4326)
+
+    @pytest.mark.django_db
+    def test_postcode_point_forgets_changed_codepoints(self):
+        self.assertIsNone(postcode_point('ME58TL'))
+
+        codepoint = self.create_codepoint('ME58TL', -1.8335, 55.4168)
+        self.assertAlmostEqual(postcode_point('ME58TL').x, -1.8335)
+
+        codepoint.point = Point(-1.5, 55.5, srid=4326)
+        codepoint.save()
+        self.assertAlmostEqual(postcode_point('ME58TL').x, -1.5)
+
+        codepoint.delete()
+        self.assertIsNone(postcode_point('ME58TL'))
+
+    @pytest.mark.django_db
+    def test_postcode_point_finds_codepoints_created_elsewhere(self):
+        self.assertIsNone(postcode_point('ME58TL'))
+
+        # as another process would, without forgetting the postcode here
+        CodePoint.objects.bulk_create([CodePoint(
+            postcode='ME58TL', quality=10,
+            point=Point(-1.8335, 55.4168, srid=4326))])
+
+        self.assertAlmostEqual(postcode_point('ME58TL').x, -1.8335)
+
+    @pytest.mark.django_db
+    def test_preloaded_postcodes(self):
+        self.create_codepoint('ME58TL', -1.8335, 55.4168)
+        self.create_codepoint('AA11ZZ', -1.5, 55.5)
+
+        with preloaded_postcodes():
+            with CaptureQueriesContext(connection) as queries:
+                self.assertAlmostEqual(postcode_point('AA1 1ZZ').x, -1.5)
+                self.assertAlmostEqual(postcode_point('ME58TL').y, 55.4168)
+                self.assertIsNone(postcode_point('XX11YY'))
+
+        self.assertEqual(len(queries), 0)
+
+    def test_postcode_table(self):
+        table = PostcodeTable([('AA11ZZ', 1.0, 2.0), ('ME58TL', 3.0, 4.0)])
+
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get('ME58TL'), (3.0, 4.0))
+        self.assertIsNone(table.get('BB11ZZ'))
+        self.assertIsNone(table.get('ZZ11ZZ'))
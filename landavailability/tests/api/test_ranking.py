@@ -4,6 +4,7 @@ import os.path
 from pprint import pprint
 from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
 from pandas.util.testing import assert_frame_equal, assert_series_equal
 
@@ -256,6 +257,62 @@ class TestRanking(TestCase):
             df['score'],
             pd.Series([0.67, 1.414214, 0.0, 1.732051], name='score'))
 
+    def test_score_matrix(self):
+        ideal_values = OrderedDict([
+            ('area_suitable', 1),
+            ('geoattributes.BROADBAND', 1),
+            ('geoattributes.DISTANCE TO BUS STOP', 0),
+            ])
+        features = np.array([
+            [1.0, 1.0, 100.0],
+            [0.0, 0.0, 300.0],
+            [1.0, np.nan, 200.0],
+            ])
+        scaled, scores = ranking.score_matrix(features, ideal_values)
+        np.testing.assert_array_almost_equal(
+            scaled,
+            np.array([
+                [1.0, 1.0, 1.0],
+                [0.0, 0.0, 0.0],
+                [1.0, 0.0, 0.5],
+                ]))
+        np.testing.assert_array_almost_equal(
+            scores, np.array([1.732051, 0.0, 1.118034]))
+
+    def test_greenbelt_overlap_ratio_feature(self):
+        class FakeLocation(object):
+            pass
+
+        locations = []
+        for location_id, overlap, ratio in ((1, True, 0.25), (2, False, 0.0)):
+            location = FakeLocation()
+            location.id = location_id
+            for attr in ranking.LOCATION_FEATURES.values():
+                setattr(location, attr, 0.0)
+            location.greenbelt_overlap = overlap
+            location.greenbelt_overlap_ratio = ratio
+            locations.append(location)
+
+        boolean_config = ranking.SchoolRankingConfig(
+            0, 0, school_type='primary_school')
+        ratio_config = ranking.SchoolRankingConfig(
+            0, 0, school_type='primary_school', greenbelt_ratio=True)
+
+        self.assertEqual(
+            list(boolean_config.locations_to_dataframe(
+                locations)['greenbelt overlap']), [1.0, 0.0])
+        self.assertEqual(
+            list(ratio_config.locations_to_dataframe(
+                locations)['greenbelt overlap']), [0.25, 0.0])
+
+        column = list(ratio_config.ideal_values).index('greenbelt overlap')
+        self.assertEqual(
+            boolean_config.features_sql()[0][column],
+            'greenbelt_overlap::int::float8')
+        self.assertEqual(
+            ratio_config.features_sql()[0][column],
+            'greenbelt_overlap_ratio::float8')
+
     def test_school_site_size_range(self):
         self.assertEqual(
             ranking.school_site_size_range(
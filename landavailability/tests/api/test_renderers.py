@@ -0,0 +1,31 @@
+from unittest import TestCase
+from collections import OrderedDict
+from rest_framework.renderers import JSONRenderer
+from api.renderers import LocationsJSONRenderer
+
+
+class TestLocationsJSONRenderer(TestCase):
+    def test_render_plain_data(self):
+        data = {'locations': [OrderedDict([
+            ('id', 1), ('name', 'Land at Lameside'),
+            ('site_size', 1234.5), ('greenbelt_overlap', False),
+            ('geom', {'type': 'Point', 'coordinates': [-2.1, 53.5]})])]}
+
+        self.assertEqual(
+            LocationsJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_render_falls_back_to_json_renderer(self):
+        from decimal import Decimal
+        data = [{'estimated_floor_space': Decimal('12.50')}]
+
+        self.assertEqual(
+            LocationsJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_render_indented(self):
+        data = [{'id': 1}]
+        renderer_context = {'indent': 4}
+
+        self.assertEqual(
+            LocationsJSONRenderer().render(
+                data, 'application/json', renderer_context),
+            JSONRenderer().render(data, 'application/json', renderer_context))
@@ -9,7 +9,11 @@ from api.serializers import (
     BusStopSerializer, TrainStopSerializer, AddressSerializer,
     CodePointSerializer, BroadbandSerializer, MetroTubeSerializer,
     GreenbeltSerializer, MotorwaySerializer, SubstationSerializer,
-    OverheadLineSerializer, SchoolSerializer, LocationSerializer)
+    OverheadLineSerializer, SchoolSerializer, LocationSerializer,
+    UpsertModelSerializer, location_rows)
+from api.geometry import with_geometry
+from api.renderers import LocationsJSONRenderer
+from rest_framework.renderers import JSONRenderer
 
 
 class TestBusStopSerializer(TestCase):
@@ -38,6 +42,41 @@ class TestBusStopSerializer(TestCase):
         serializer.save()
         self.assertEqual(BusStop.objects.count(), 1)
 
+    @pytest.mark.django_db
+    def test_busstop_serializer_create_many_objects(self):
+        BusStop.objects.create(
+            amic_code='1800AMIC001', point=Point(-2.3477, 53.3873),
+            name='Old name')
+
+        data = [
+            {
+                'amic_code': amic_code,
+                'point': {
+                    'type': 'Point',
+                    'coordinates': [-2.347743000012108, 53.38737090322739]
+                },
+                'name': name,
+                'srid': 4326
+            }
+            for amic_code, name in (
+                ('1800AMIC001', 'Altrincham Interchange'),
+                ('1800AMIC002', 'Stamford New Road'),
+                ('1800AMIC002', 'Stamford New Rd'))]
+        serializer = BusStopSerializer(data=data, many=True)
+        self.assertTrue(serializer.is_valid())
+
+        bus_stops = serializer.save()
+        self.assertEqual(len(bus_stops), 3)
+        self.assertEqual(serializer.created, 1)
+        self.assertEqual(serializer.updated, 1)
+        self.assertEqual(BusStop.objects.count(), 2)
+        self.assertEqual(
+            BusStop.objects.get(amic_code='1800AMIC001').name,
+            'Altrincham Interchange')
+        self.assertEqual(
+            BusStop.objects.get(amic_code='1800AMIC002').name,
+            'Stamford New Rd')
+
 
 class TestTrainStopSerializer(TestCase):
     @pytest.mark.django_db
@@ -467,6 +506,39 @@ class TestSchoolSerializer(TestCase):
         self.assertEqual(School.objects.count(), 1)
 
 
+class PlainSchoolSerializer(UpsertModelSerializer):
+    class Meta:
+        model = School
+        fields = '__all__'
+        extra_kwargs = {
+            'urn': {
+                'validators': [],
+            }
+        }
+
+
+class TestUpsertModelSerializer(TestCase):
+    @pytest.mark.django_db
+    def test_default_build(self):
+        data = {
+            'urn': '100000',
+            'school_name': 'School',
+            'point': {'type': 'Point', 'coordinates': [-0.1, 51.5]},
+        }
+
+        serializer = PlainSchoolSerializer(data=data)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        data['school_name'] = 'Renamed School'
+        serializer = PlainSchoolSerializer(data=data)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        self.assertEqual(School.objects.count(), 1)
+        self.assertEqual(School.objects.get().school_name, 'Renamed School')
+
+
 class TestLocationSerializer(TestCase):
     @pytest.mark.django_db
     def test_location_serializer_create_object(self):
@@ -555,3 +627,41 @@ class TestLocationSerializer(TestCase):
 
         serializer.save()
         self.assertEqual(Location.objects.count(), 1)
+
+    @pytest.mark.django_db
+    def test_location_rows_render_the_same_bytes(self):
+        data = {
+            'uprn': '123456789AB',
+            'name': 'Caf\u00e9 site\u2028(10910)',
+            'estimated_floor_space': 140.24,
+            'geom': {
+                'type': 'MultiPolygon',
+                'coordinates': [[[
+                    [-2.1614837256814963, 53.07183331520438],
+                    [-2.161373377871479, 53.071211109880664],
+                    [-2.1620568237599738, 53.07147709017702],
+                    [-2.1614837256814963, 53.07183331520438],
+                    ]]]
+                },
+            'srid': 4326,
+            }
+        serializer = LocationSerializer(data=data)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        serializer = LocationSerializer(data=dict(data, uprn='2', name=None))
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        for context in ({},
+                        {'geometry': 'simplified', 'zoom': 20,
+                         'precision': 6},
+                        {'geometry': 'centroid'},
+                        {'geometry': 'none'},
+                        {'fields': ['name', 'geom']}):
+            locations = with_geometry(
+                Location.objects.order_by('id'), **context)
+            expected = JSONRenderer().render(LocationSerializer(
+                locations, many=True, context=context).data)
+            rendered = LocationsJSONRenderer().render(
+                list(location_rows(locations, context=context).values()))
+            self.assertEqual(rendered, expected)
@@ -5,6 +5,9 @@ import pytest
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework.authtoken.models import Token
@@ -62,6 +65,84 @@ class TestBusStopView(LandAvailabilityAdminAPITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(BusStop.objects.count(), 1)
 
+    @pytest.mark.django_db
+    def test_busstop_view_create_many(self):
+        url = reverse('busstops-create')
+        records = [
+            {
+                "amic_code": "1800AMIC00{0}".format(i),
+                "point": {
+                    "type": "Point",
+                    "coordinates": [-2.347743000012108, 53.38737090322739]
+                },
+                "name": "Bus Stop {0}".format(i),
+                "srid": 4326
+            }
+            for i in range(3)]
+
+        response = self.client.post(url, records[:2], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.json(), {'received': 2, 'created': 2, 'updated': 0})
+
+        response = self.client.post(
+            url, '\n'.join(json.dumps(record) for record in records),
+            content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.json(), {'received': 3, 'created': 1, 'updated': 2})
+        self.assertEqual(BusStop.objects.count(), 3)
+
+    @pytest.mark.django_db
+    def test_busstop_view_create_many_duplicated_key(self):
+        url = reverse('busstops-create')
+        records = [
+            {
+                "amic_code": amic_code,
+                "point": {
+                    "type": "Point",
+                    "coordinates": [-2.347743000012108, 53.38737090322739]
+                },
+                "name": name,
+                "srid": 4326
+            }
+            for amic_code, name in (
+                ("1800AMIC001", "Bus Stop"),
+                ("1800AMIC002", "Other Bus Stop"),
+                ("1800AMIC001", "Renamed Bus Stop"))]
+
+        response = self.client.post(url, records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.json(), {'received': 3, 'created': 2, 'updated': 0})
+        self.assertEqual(
+            BusStop.objects.get(amic_code='1800AMIC001').name,
+            'Renamed Bus Stop')
+
+        response = self.client.post(url, records, format='json')
+        self.assertEqual(
+            response.json(), {'received': 3, 'created': 0, 'updated': 2})
+
+    @pytest.mark.django_db
+    def test_busstop_view_create_many_invalid(self):
+        url = reverse('busstops-create')
+        records = [
+            {
+                "amic_code": "1800AMIC001",
+                "point": {
+                    "type": "Point",
+                    "coordinates": [-2.347743000012108, 53.38737090322739]
+                },
+                "srid": 4326
+            },
+            {"amic_code": "1800AMIC002", "srid": 4326}]
+
+        response = self.client.post(url, records, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['invalid'], 1)
+        self.assertEqual(list(response.json()['errors']), ['1'])
+        self.assertEqual(BusStop.objects.count(), 0)
+
 
 class TestTrainStopView(LandAvailabilityAdminAPITestCase):
     @pytest.mark.django_db
@@ -367,6 +448,35 @@ class TestMotorwayView(LandAvailabilityAdminAPITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(Motorway.objects.count(), 1)
 
+    @pytest.mark.django_db
+    def test_motorway_view_keeps_nearest_beyond_1km(self):
+        url = reverse('motorways-create')
+        # about 3km north of FIXTURE_LOCATION_1
+        data = {
+            "identifier": "M11 J13",
+            "number": "M11",
+            "point": {
+                "type": "Point",
+                "coordinates": [0.1315, 52.2327]
+            },
+            "srid": 4326
+        }
+        self.client.post(url, data, format='json')
+
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_1)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        location = Location.objects.get()
+        self.assertEqual(location.nearest_motorway.identifier, 'M11 J13')
+        self.assertTrue(2000 < location.nearest_motorway_distance < 5000)
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        location = Location.objects.get()
+        self.assertEqual(location.nearest_motorway.identifier, 'M11 J13')
+        self.assertTrue(2000 < location.nearest_motorway_distance < 5000)
+
 
 class TestSubstationView(LandAvailabilityAdminAPITestCase):
     @pytest.mark.django_db
@@ -455,6 +565,41 @@ class TestOverheadLineView(LandAvailabilityAdminAPITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(OverheadLine.objects.count(), 1)
 
+    @pytest.mark.django_db
+    def test_overheadline_view_keeps_nearest_beyond_1km(self):
+        url = reverse('overheadlines-create')
+        # about 2.7km north of FIXTURE_LOCATION_1
+        data = {
+            "gdo_gid": "43167",
+            "route_asset": "ZZA",
+            "towers": "ZZA ROUTE TWR (001 - 002)",
+            "action_dtt": "20140714",
+            "status": "C",
+            "operating": "400",
+            "circuit_1": "BURWELL - EATON SOCON",
+            "circuit_2": "",
+            "geom": {
+                "coordinates": [[0.10, 52.23], [0.16, 52.23]],
+                "type": "LineString"
+            },
+            "srid": 4326
+        }
+        self.client.post(url, data, format='json')
+
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_1)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        location = Location.objects.get()
+        self.assertEqual(location.nearest_ohl.gdo_gid, '43167')
+        self.assertTrue(2000 < location.nearest_ohl_distance < 3000)
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        location = Location.objects.get()
+        self.assertEqual(location.nearest_ohl.gdo_gid, '43167')
+        self.assertTrue(2000 < location.nearest_ohl_distance < 3000)
+
 
 class TestSchoolView(LandAvailabilityAdminAPITestCase):
     @pytest.mark.django_db
@@ -939,6 +1084,39 @@ class TestLocationDetailsView(LandAvailabilityUserAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.json()['uprn'], '010090969113')
 
+    @pytest.mark.django_db
+    def test_location_details_geometry_levels(self):
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_1)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        url = reverse('location-details', kwargs={'uprn': '010090969113'})
+
+        response = self.client.get(url, {'geometry': 'simplified'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['geom']['type'], 'MultiPolygon')
+
+        response = self.client.get(
+            url, {'geometry': 'centroid', 'precision': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        geom = response.json()['geom']
+        self.assertEqual(geom['type'], 'Point')
+        self.assertEqual(
+            geom['coordinates'], [round(c, 3) for c in geom['coordinates']])
+
+        response = self.client.get(url, {'geometry': 'none'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.json()['geom'])
+        self.assertEqual(response.json()['uprn'], '010090969113')
+
+    @pytest.mark.django_db
+    def test_location_details_invalid_geometry(self):
+        url = reverse('location-details', kwargs={'uprn': '010090969113'})
+        response = self.client.get(url, {'geometry': 'tiny'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'precision': 'high'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     @pytest.mark.django_db
     def test_location_details_has_broadband(self):
         # Create test CodePoint
@@ -1272,6 +1450,268 @@ class TestLocationSearch(LandAvailabilityUserAPITestCase):
         self.assertEqual(len(response.json()['locations']), 3)
         self.assertEqual(response.json()['locations'][0]['name'], 'Test Location 3')
 
+    @pytest.mark.django_db
+    def test_ranking_second_page(self):
+        # Create test Locations
+        for fixture in (
+                FIXTURE_LOCATION_1, FIXTURE_LOCATION_2, FIXTURE_LOCATION_3):
+            serializer = LocationSerializer(data=fixture)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+        busstop = BusStop(name='Test Bus Stop',
+                          point=Point(*FIXTURE_BUS_STOP_CAMBRIDGE))
+        busstop.save()
+        busstop.update_close_locations(default_range=3000)
+
+        url = reverse('locations')
+        first_page = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(),
+                      build='secondary_school', page_size=2)).json()
+        second_page = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(),
+                      build='secondary_school', page_size=2, page=2)).json()
+
+        self.assertEqual(len(first_page['locations']), 2)
+        self.assertEqual(len(second_page['locations']), 1)
+        self.assertNotIn(
+            second_page['locations'][0]['id'],
+            [l['id'] for l in first_page['locations']])
+        self.assertTrue(
+            second_page['locations'][0]['score'] <=
+            first_page['locations'][1]['score'])
+
+    @pytest.mark.django_db
+    def test_location_view_cursor_pages(self):
+        # Create test Locations
+        for fixture in (
+                FIXTURE_LOCATION_1, FIXTURE_LOCATION_2, FIXTURE_LOCATION_3):
+            serializer = LocationSerializer(data=fixture)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+        url = reverse('locations')
+        first_page = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(),
+                      page_size=2, cursor='')).json()
+        self.assertEqual(len(first_page['locations']), 2)
+        self.assertIsNotNone(first_page['next_cursor'])
+
+        second_page = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), page_size=2,
+                      cursor=first_page['next_cursor'])).json()
+        self.assertEqual(len(second_page['locations']), 1)
+        self.assertIsNone(second_page['next_cursor'])
+
+        ids = [l['id'] for l in
+               first_page['locations'] + second_page['locations']]
+        self.assertEqual(ids, sorted(Location.objects.values_list(
+            'id', flat=True)))
+
+    @pytest.mark.django_db
+    def test_location_view_render_postgis(self):
+        # Create test Locations
+        for fixture in (
+                FIXTURE_LOCATION_1, FIXTURE_LOCATION_2, FIXTURE_LOCATION_3):
+            serializer = LocationSerializer(data=fixture)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+        url = reverse('locations')
+        expected = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), page_size=2,
+                      cursor='')).json()
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), page_size=2, cursor='',
+                      render='postgis'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(
+            b''.join(response.streaming_content).decode('utf-8'))
+
+        self.assertEqual(data['next_cursor'], expected['next_cursor'])
+        self.assertEqual(len(data['locations']), 2)
+        for location, expected_location in zip(
+                data['locations'], expected['locations']):
+            self.assertEqual(list(location), list(expected_location))
+            self.assertEqual(location['uprn'], expected_location['uprn'])
+            self.assertEqual(location['estimated_floor_space'],
+                             expected_location['estimated_floor_space'])
+            self.assertEqual(location['geom']['type'], 'MultiPolygon')
+            self.assertAlmostEqual(
+                location['point']['coordinates'][0],
+                expected_location['point']['coordinates'][0])
+
+    @pytest.mark.django_db
+    def test_location_view_render_postgis_with_build(self):
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), build='secondary_school',
+                      render='postgis'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # the DatasetVersion is bumped on commit
+    @pytest.mark.django_db(transaction=True)
+    def test_location_view_etag(self):
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_1)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        url = reverse('locations')
+        response = self.client.get(url, POLYGON_CAMBRIDGE)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response = self.client.get(
+            url, POLYGON_CAMBRIDGE, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_2)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        response = self.client.get(
+            url, POLYGON_CAMBRIDGE, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()['locations']), 2)
+
+    # the DatasetVersion is bumped on commit
+    @pytest.mark.django_db(transaction=True)
+    def test_location_view_search_cache(self):
+        caches['default'].clear()
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_1)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        url = reverse('locations')
+        with self.settings(LOCATION_SEARCH_CACHE='default'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, POLYGON_CAMBRIDGE)
+            with CaptureQueriesContext(connection) as cached_queries:
+                cached_response = self.client.get(url, POLYGON_CAMBRIDGE)
+
+            self.assertEqual(cached_response.content, response.content)
+            self.assertLess(len(cached_queries), len(queries))
+
+            serializer = LocationSerializer(data=FIXTURE_LOCATION_2)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+            response = self.client.get(url, POLYGON_CAMBRIDGE)
+            self.assertEqual(len(response.json()['locations']), 2)
+
+    @pytest.mark.django_db
+    def test_location_view_site_size_filter(self):
+        # Create test Locations
+        for fixture in (
+                FIXTURE_LOCATION_1, FIXTURE_LOCATION_2, FIXTURE_LOCATION_3):
+            serializer = LocationSerializer(data=fixture)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+        site_sizes = sorted(
+            Location.objects.values_list('site_size', flat=True))
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(),
+                      min_site_size=site_sizes[1]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(l['site_size'] for l in response.json()['locations']),
+            site_sizes[1:])
+
+    @pytest.mark.django_db
+    def test_location_view_invalid_site_size(self):
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), max_site_size='big'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @pytest.mark.django_db
+    def test_location_view_geometry_none(self):
+        serializer = LocationSerializer(data=FIXTURE_LOCATION_1)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), geometry='none'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['locations']), 1)
+        self.assertIsNone(response.json()['locations'][0]['geom'])
+
+    @pytest.mark.django_db
+    def test_location_view_sparse_fields(self):
+        for fixture in (
+                FIXTURE_LOCATION_1, FIXTURE_LOCATION_2, FIXTURE_LOCATION_3):
+            serializer = LocationSerializer(data=fixture)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), fields='id,name'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for location in response.json()['locations']:
+            self.assertEqual(set(location), {'id', 'name'})
+
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(),
+                      build='secondary_school', fields='name,score'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['locations']), 3)
+        for location in response.json()['locations']:
+            self.assertEqual(set(location), {'name', 'score'})
+
+    @pytest.mark.django_db
+    def test_location_view_invalid_fields(self):
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), fields='name,srid'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), fields='name,score'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @pytest.mark.django_db
+    def test_location_view_invalid_cursor(self):
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), cursor='not a cursor'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @pytest.mark.django_db
+    def test_ranking_info_matches_location(self):
+        # Create test Locations
+        for fixture in (
+                FIXTURE_LOCATION_1, FIXTURE_LOCATION_2, FIXTURE_LOCATION_3):
+            serializer = LocationSerializer(data=fixture)
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+
+        busstop = BusStop(name='Test Bus Stop',
+                          point=Point(*FIXTURE_BUS_STOP_CAMBRIDGE))
+        busstop.save()
+        busstop.update_close_locations(default_range=3000)
+
+        url = reverse('locations')
+        response = self.client.get(
+            url, dict(POLYGON_CAMBRIDGE.items(), build='secondary_school'))
+        locations = response.json()['locations']
+
+        # the closest to the bus stop scores best (1.0) for that column
+        closest = min(
+            [l for l in locations
+             if l['nearest_busstop_distance'] is not None],
+            key=lambda l: l['nearest_busstop_distance'])
+        self.assertEqual(
+            closest['geoattributes.DISTANCE TO BUS STOP'], 1.0)
+        scores = [l['score'] for l in locations]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
     @pytest.mark.django_db
     def test_ranking_no_pupils_param(self):
         url = reverse('locations')
@@ -0,0 +1,11 @@
+import sys
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def forget_postcodes():
+    # the rows are rolled back after each test, without any signal, so the
+    # cached postcodes would outlive them
+    postcodes = sys.modules.get('api.postcodes')
+    if postcodes is not None:
+        postcodes.forget_all_postcodes()
@@ -27,11 +27,23 @@ from api.management.commands.import_schools import (
 from api.management.commands.import_metrotube import (
     Command as MetroTubeCommand,
 )
+from api.management.commands.import_motorways import (
+    Command as MotorwayCommand,
+)
+from api.management.commands.importers import iter_features, open_shapefile
 from api.models import (
     Address, BusStop, CodePoint, TrainStop, Location, Broadband, Greenbelt,
-    School, MetroTube)
-from django.contrib.gis.geos import Point
+    School, MetroTube, Motorway)
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import io
 import json
+import os
+import shapefile
+import shutil
+import tempfile
 
 
 class TestAddressCommand(TestCase):
@@ -62,6 +74,46 @@ class TestAddressCommand(TestCase):
                 float("55.4168769443259"),
                 srid=4326))
 
+    @pytest.mark.django_db
+    def test_import_addresses_through_staging_table(self):
+        # a table with the staging table's name, as another import could
+        # have, is left alone
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE api_address_staging (uprn text)')
+            cursor.execute("INSERT INTO api_address_staging VALUES ('1')")
+
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.csv', delete=False) as csvfile:
+            csvfile.write(
+                '"123456","273548175","Dataland","Main Street","",'
+                '"Dataland City","Cucumberland","AA11 1ZZ","GB",'
+                '"55.4168769443259","-1.83356713993623"\n'
+                '"123457","273548176","Elsewhere","","","Dataland City",'
+                '"Cucumberland","AA11 1ZY","GB","",""\n'
+                '"123456","273548175","Dataland","High Street","",'
+                '"Dataland City","Cucumberland","AA11 1ZZ","GB",'
+                '"55.4168769443259","-1.83356713993623"\n')
+
+        try:
+            call_command('import_addresses', csvfile.name)
+        finally:
+            os.remove(csvfile.name)
+
+        # the address without coordinates is skipped
+        self.assertEqual(Address.objects.count(), 1)
+        address = Address.objects.get()
+        self.assertEqual(address.uprn, '123456')
+        self.assertEqual(address.address_line_2, 'High Street')
+        self.assertEqual(address.address_line_3, '')
+        self.assertEqual(address.postcode, 'AA111ZZ')
+        self.assertEqual(
+            address.point, Point(-1.83356713993623, 55.4168769443259,
+                                 srid=4326))
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT uprn FROM public.api_address_staging')
+            self.assertEqual(cursor.fetchall(), [('1',)])
+
 
 class TestBusStopCommand(TestCase):
     @pytest.mark.django_db
@@ -84,6 +136,29 @@ class TestBusStopCommand(TestCase):
         self.assertEqual(bus_stop.road, 'HONOLULU NEW RD')
         self.assertEqual(bus_stop.nptg_code, 'A00223344')
 
+    @pytest.mark.django_db
+    def test_import_bus_stop_process_rows(self):
+        bus_stop_rows = [
+            ["1800AMIC001", "", "376969", "387893", "Honolulu Interchange",
+             "Nr Train Station", "NA", "HONOLULU NEW RD", "", "A00223344"],
+            ["1800AMIC002", "", "376970", "387894", "Honolulu Main Street",
+             "Nr Post Office", "NA", "HONOLULU NEW RD", "", "A00223344"],
+            ["1800AMIC003", "", "not a number", "387894", "Broken",
+             "", "NA", "", "", ""],
+            ["1800AMIC001", "", "376969", "387893", "Honolulu Bus Station",
+             "Nr Train Station", "NA", "HONOLULU NEW RD", "", "A00223344"],
+        ]
+
+        BusStopCommand().process_rows(bus_stop_rows)
+        self.assertEqual(BusStop.objects.count(), 2)
+
+        bus_stop = BusStop.objects.get(amic_code='1800AMIC001')
+        self.assertEqual(bus_stop.name, 'Honolulu Bus Station')
+
+        # importing the same rows again updates the existing bus stops
+        BusStopCommand().process_rows(bus_stop_rows)
+        self.assertEqual(BusStop.objects.count(), 2)
+
 
 class TestCodePointCommand(TestCase):
     @pytest.mark.django_db
@@ -105,6 +180,31 @@ class TestCodePointCommand(TestCase):
         self.assertEqual(codepoint.district, 'E08000002')
         self.assertEqual(codepoint.ward, 'E05000681')
 
+    @pytest.mark.django_db
+    def test_import_codepoints_through_staging_table(self):
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.csv', delete=False) as csvfile:
+            csvfile.write(
+                '"BL0 0AA",10,379448,416851,"E92000001","E19000001",'
+                '"E18000002","","E08000002","E05000681"\n'
+                '"BL0 0AB",10,379449,416852,"E92000001","E19000001",'
+                '"E18000002","","E08000002","E05000681"\n'
+                '"BL0 0AA",20,379448,416851,"E92000001","E19000001",'
+                '"E18000002","","E08000002","E05000682"\n')
+
+        try:
+            call_command('import_codepoints', csvfile.name)
+        finally:
+            os.remove(csvfile.name)
+
+        self.assertEqual(CodePoint.objects.count(), 2)
+
+        codepoint = CodePoint.objects.get(postcode='BL00AA')
+        self.assertEqual(codepoint.quality, 20)
+        self.assertEqual(codepoint.county, '')
+        self.assertEqual(codepoint.ward, 'E05000682')
+        self.assertEqual(codepoint.point.srid, 4326)
+
 
 class TestTrainStopCommand(TestCase):
     @pytest.mark.django_db
@@ -174,6 +274,65 @@ class TestManchesterLandCommand(TestCase):
         ManchesterLandsCommand().process_feature(json.loads(feature_json))
         self.assertEqual(Location.objects.count(), 1)
 
+    @pytest.mark.django_db
+    def test_import_manchester_lands_from_file(self):
+        def feature(address, x):
+            return {
+                "type": "Feature",
+                "properties": {"la": "Bolton", "address": address},
+                "geometry": {
+                    "coordinates": [[[
+                        [x, 0.0], [x + 1.0, 0.0], [x + 1.0, 1.0],
+                        [x, 1.0], [x, 0.0]]]],
+                    "type": "MultiPolygon"
+                }
+            }
+
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.json', delete=False) as jsonfile:
+            json.dump({
+                "type": "FeatureCollection",
+                "features": [
+                    feature("Site A", 100.0),
+                    feature("Site B", 102.0),
+                    feature("Site A", 100.0),
+                ]
+            }, jsonfile)
+
+        try:
+            call_command(
+                'import_manchester_lands', jsonfile.name, batch_size=2)
+        finally:
+            os.remove(jsonfile.name)
+
+        self.assertEqual(
+            sorted(Location.objects.values_list('name', flat=True)),
+            ['Site A', 'Site B'])
+
+
+class TestIterFeatures(TestCase):
+    def test_iter_features(self):
+        features = [
+            {"type": "Feature", "id": str(i), "properties": {"n": i * 1.5},
+             "geometry": {"type": "Point", "coordinates": [i, i]}}
+            for i in range(10)]
+        feature_collection = json.dumps({
+            "type": "FeatureCollection",
+            "crs": {"type": "name", "properties": {"name": "EPSG:4326"}},
+            "features": features,
+            "totalFeatures": 10
+        })
+
+        for read_size in (1, 7, 1024):
+            self.assertEqual(
+                list(iter_features(
+                    io.StringIO(feature_collection), read_size)),
+                features)
+
+    def test_iter_features_truncated_file(self):
+        with self.assertRaises(ValueError):
+            list(iter_features(io.StringIO('{"features": [{"id": 1}')))
+
 
 class TestBroadbandCommand(TestCase):
     @pytest.mark.django_db
@@ -308,6 +467,36 @@ class TestGreenbeltCommand(TestCase):
         GreenbeltCommand().process_feature(json.loads(feature_json))
         self.assertEqual(Greenbelt.objects.count(), 1)
 
+    def create_greenbelt(self, code):
+        return Greenbelt(
+            code=code, la_name='Stoke', gb_name='Stoke Greenbelt',
+            ons_code='E06000021', year='2014/15',
+            geom=MultiPolygon(Polygon((
+                (-2.162, 53.071), (-2.161, 53.071), (-2.161, 53.072),
+                (-2.162, 53.071)))))
+
+    def count_overlap_refreshes(self, queries):
+        return len([
+            query for query in queries
+            if query['sql'].startswith('UPDATE') and
+            'greenbelt_overlap_ratio' in query['sql']])
+
+    @pytest.mark.django_db
+    def test_import_greenbelt_refreshes_overlap_once(self):
+        command = GreenbeltCommand()
+
+        # a batch is written without post_save, and refreshed by the command
+        with CaptureQueriesContext(connection) as queries:
+            command.save_batch([('GB1', self.create_greenbelt('GB1'))])
+        self.assertEqual(self.count_overlap_refreshes(queries), 1)
+
+        # a single Greenbelt is refreshed by the post_save handler
+        with CaptureQueriesContext(connection) as queries:
+            command.save_one('GB2', self.create_greenbelt('GB2'))
+        self.assertEqual(self.count_overlap_refreshes(queries), 1)
+
+        self.assertEqual(Greenbelt.objects.count(), 2)
+
 
 class TestSchoolCommand(TestCase):
     @pytest.mark.django_db
@@ -357,3 +546,58 @@ class TestMetroTubeCommand(TestCase):
 
         metrotube = MetroTube.objects.first()
         self.assertEqual(metrotube.atco_code, "0100BRP90207")
+
+
+class TestMotorwayCommand(TestCase):
+    def setUp(self):
+        self.shp_dir = tempfile.mkdtemp()
+        self.shp_file_name = os.path.join(self.shp_dir, 'motorways')
+
+        writer = shapefile.Writer(shapefile.POINT)
+        writer.field('IDENTIFIER', 'C', 40)
+        writer.field('NUMBER', 'C', 40)
+        writer.point(379448, 416851)
+        writer.record('M60 J1', 'M60')
+        writer.point(379449, 416852)
+        writer.record('M60 J2', 'M60')
+        writer.point(379450, 416853)
+        writer.record('M62 J1', 'M62')
+        writer.save(self.shp_file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.shp_dir)
+
+    @pytest.mark.django_db
+    def test_import_motorways_in_chunks(self):
+        call_command(
+            'import_motorways', self.shp_file_name + '.shp', chunk_size=2)
+        self.assertEqual(Motorway.objects.count(), 3)
+
+        motorway = Motorway.objects.get(identifier='M62 J1')
+        self.assertEqual(motorway.number, 'M62')
+        self.assertEqual(motorway.point.srid, 4326)
+
+    # The workers write through their own connections, so the rows have to
+    # be committed rather than kept in the test's transaction
+    @pytest.mark.django_db(transaction=True)
+    def test_import_motorways_in_parallel(self):
+        call_command(
+            'import_motorways', self.shp_file_name + '.shp', chunk_size=1,
+            workers=2)
+        self.assertEqual(
+            sorted(Motorway.objects.values_list('identifier', flat=True)),
+            ['M60 J1', 'M60 J2', 'M62 J1'])
+
+    def test_open_shapefile_closes_files(self):
+        with open_shapefile(self.shp_file_name + '.shp') as reader:
+            self.assertEqual(reader.numRecords, 3)
+
+        for f in (reader.shp, reader.shx, reader.dbf):
+            self.assertTrue(f.closed)
+
+    @pytest.mark.django_db
+    def test_import_motorways_import_shard(self):
+        MotorwayCommand().import_shard(self.shp_file_name + '.shp', 1, 3)
+        self.assertEqual(
+            sorted(Motorway.objects.values_list('identifier', flat=True)),
+            ['M60 J2', 'M62 J1'])